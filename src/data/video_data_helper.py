@@ -1,70 +1,263 @@
+import hashlib
 import logging
+import os
 import pdb
 import random
 import torch
 import numpy as np
 import pickle
 import glob
+import time
 logger = logging.getLogger(__name__)
 
 
 SCORE_THRESHOLD = 0.8
 
 
+CSV_COLUMNS = [
+    ('sec', np.int64),
+    ('x1', np.float64),
+    ('y1', np.float64),
+    ('x2', np.float64),
+    ('y2', np.float64),
+    ('action', 'U8'),
+    ('score', 'U32'),
+    ('link_id', np.int64),
+    ('scene_id', np.int64),
+]
+
+
 def load_video_data(in_file_name, args):
-    videos = {}
-    if '@@@' in in_file_name:
-        file_names = in_file_name.split('@@@')
-    else:
-        file_names = [in_file_name]
-    for file_name in file_names:
+    parts = []
+    for file_name in split_file_names(in_file_name):
         if len(file_name) == 0:
             continue
 
         is_gt = 'train.csv' in file_name
         logger.info('Loading from %s (is GT? %s)' % (file_name, str(is_gt)))
-        with open(file_name, 'r') as f:
-            for line in f:
-                items = line.split(',')
-                assert len(items) == 11
-                if not is_gt:
-                    score = float(items[7])
-                    assert score <= 1.0 and score >= 0.0, score
-                    if score < SCORE_THRESHOLD:
-                        continue
-
-                video_name = items[0]
-                if is_gt:
-                    video_name = 'GT_' + video_name
-                scene_id = int(items[-2])
-                link_id = int(items[-3])
-                box = ','.join(items[2:6])
-                if items[6] == '':
-                    action = -1
-                else:
-                    action = int(items[6]) - 1
-
-                sec = int(items[1])
-
-                if video_name not in videos:
-                    videos[video_name] = {}
-                    prev_scene_id = -1
-
-                assert scene_id >= prev_scene_id, (scene_id, prev_scene_id)
-                prev_scene_id = scene_id
-
-                if sec not in videos[video_name]:
-                    videos[video_name][sec] = {}
-
-                if box in videos[video_name][sec]:
-                    assert videos[video_name][sec][box][:2] == (scene_id, link_id)
-                    videos[video_name][sec][box][2].append(action)
-                else:
-                    videos[video_name][sec][box] = (scene_id, link_id, [action])
+        parts.append(load_video_columns(
+            file_name, is_gt, overwrite_cache=getattr(args, 'overwrite_cache', False)))
+    if not parts:
+        raise ValueError(
+            'No data files in %r (--train_data_file/--eval_data_file)' % in_file_name)
+
+    videos = VideoTable.from_columns(parts)
+    logger.info('\t{} videos, {} distinct boxes loaded.'.format(
+        len(videos.video_names), len(videos.box_table)))
+    return videos
 
 
-    logger.info('\t{} videos loaded.'.format(len(videos)))
-    return videos
+def load_video_columns(file_name, is_gt, overwrite_cache=False):
+    """Typed columns of one CSV, cached next to it as .npz.
+
+    The cache is keyed by path, mtime, size and SCORE_THRESHOLD, so editing
+    the CSV or the threshold re-parses it.
+    """
+    stat = os.stat(file_name)
+    key = '{}|{}|{}|{}|{}'.format(
+        os.path.abspath(file_name), stat.st_mtime_ns, stat.st_size,
+        SCORE_THRESHOLD, is_gt)
+    cache_file = '{}.{}.cache.npz'.format(
+        file_name, hashlib.md5(key.encode('utf-8')).hexdigest()[:12])
+
+    if os.path.exists(cache_file) and not overwrite_cache:
+        logger.info('Loading cached columns from %s' % cache_file)
+        with np.load(cache_file) as cache:
+            return {name: cache[name] for name in cache.files}
+
+    start = time.time()
+    columns = read_video_csv(file_name, is_gt)
+    logger.info('Parsed %d rows in %.1f secs' % (
+        len(columns['secs']), time.time() - start))
+
+    tmp_file = cache_file + '.tmp'
+    try:
+        with open(tmp_file, 'wb') as f:
+            np.savez(f, **columns)
+        os.replace(tmp_file, cache_file)
+    except OSError as e:
+        logger.warning('Could not write cache %s: %s' % (cache_file, e))
+    return columns
+
+
+def read_video_csv(file_name, is_gt):
+    names = np.loadtxt(file_name, delimiter=',', usecols=0, dtype=str, ndmin=1)
+    table = np.loadtxt(file_name, delimiter=',', usecols=range(1, 10),
+                       dtype=CSV_COLUMNS, ndmin=1)
+
+    if not is_gt:
+        score = table['score'].astype(np.float64)
+        assert ((score >= 0.0) & (score <= 1.0)).all(), 'scores must be in [0, 1]'
+        keep = score >= SCORE_THRESHOLD
+        names, table = names[keep], table[keep]
+
+    if is_gt:
+        names = np.char.add('GT_', names)
+    video_names, video_idx = unique_in_order(names)
+
+    action = np.where(table['action'] == '', '0', table['action']).astype(np.int64) - 1
+
+    return {
+        'video_names': video_names,
+        'video_idx': video_idx.astype(np.int32),
+        'secs': table['sec'].astype(np.int32),
+        'boxes': np.stack(
+            [table['x1'], table['y1'], table['x2'], table['y2']], axis=1
+        ).astype(np.float32),
+        'scene_ids': table['scene_id'].astype(np.int32),
+        'link_ids': table['link_id'].astype(np.int32),
+        'actions': action.astype(np.int16),
+    }
+
+
+def unique_in_order(values):
+    """Like np.unique(values, return_inverse=True), ordered by first appearance."""
+    uniques, first, inverse = np.unique(
+        values, return_index=True, return_inverse=True)
+    order = np.argsort(first, kind='stable')
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    return uniques[order], rank[inverse.reshape(-1)]
+
+
+class VideoTable(object):
+    """Annotation/detection rows as columns, one row per (video, sec, box).
+
+    Rows are sorted by video (in order of first appearance) and sec; boxes of
+    one second keep their file order. Row i holds the actions
+    `actions[action_offsets[i]:action_offsets[i + 1]]`, and the rows of the
+    j-th (video, sec) slot are `slot_offsets[j]:slot_offsets[j + 1]`.
+    """
+
+    def __init__(self, video_names, video_idx, secs, box_ids, scene_ids,
+                 link_ids, action_offsets, actions, box_table):
+        self.video_names = list(video_names)
+        self.video_name_to_idx = {
+            name: i for i, name in enumerate(self.video_names)}
+        self.video_idx = video_idx
+        self.secs = secs
+        self.box_ids = box_ids
+        self.scene_ids = scene_ids
+        self.link_ids = link_ids
+        self.action_offsets = action_offsets
+        self.actions = actions
+        self.box_table = box_table
+
+        num_rows = len(secs)
+        new_slot = np.ones((num_rows,), dtype=bool)
+        new_slot[1:] = (video_idx[1:] != video_idx[:-1]) | (secs[1:] != secs[:-1])
+        slot_starts = np.flatnonzero(new_slot)
+        self.slot_offsets = np.append(slot_starts, num_rows)
+        self.slot_secs = secs[slot_starts]
+        self.video_slot_offsets = np.searchsorted(
+            video_idx[slot_starts], np.arange(len(self.video_names) + 1))
+
+    def __len__(self):
+        return len(self.secs)
+
+    @classmethod
+    def from_columns(cls, parts):
+        video_names, remap = unique_in_order(
+            np.concatenate([p['video_names'] for p in parts]))
+        video_idx, name_offset = [], 0
+        for p in parts:
+            video_idx.append(remap[name_offset + p['video_idx']])
+            name_offset += len(p['video_names'])
+
+        def concat(name, dtype):
+            return np.concatenate([p[name] for p in parts]).astype(dtype)
+
+        video_idx = np.concatenate(video_idx).astype(np.int32)
+        secs = concat('secs', np.int32)
+        boxes = concat('boxes', np.float32).reshape((-1, 4))
+        scene_ids = concat('scene_ids', np.int32)
+        link_ids = concat('link_ids', np.int32)
+        actions = concat('actions', np.int16)
+
+        # Scene ids may not decrease within a video (in file order).
+        order = np.argsort(video_idx, kind='stable')
+        same_video = video_idx[order][1:] == video_idx[order][:-1]
+        assert not (same_video & (np.diff(scene_ids[order]) < 0)).any(), \
+            'scene ids decrease within a video'
+
+        box_table = BoxTable(boxes)
+        box_ids = box_table.lookup(boxes)
+
+        # Merge rows of the same (video, sec, box) and order the merged rows
+        # by (video, sec, first appearance).
+        keys = np.stack([video_idx, secs, box_ids], axis=1).astype(np.int64)
+        if len(keys) > 0:
+            _, first, inverse = np.unique(
+                keys, axis=0, return_index=True, return_inverse=True)
+        else:
+            first = inverse = np.zeros((0,), dtype=np.int64)
+        group_order = np.lexsort((first, secs[first], video_idx[first]))
+        rank = np.empty_like(group_order)
+        rank[group_order] = np.arange(len(group_order))
+        group = rank[inverse.reshape(-1)]
+        first_rows = first[group_order]
+
+        assert (scene_ids[first_rows][group] == scene_ids).all()
+        assert (link_ids[first_rows][group] == link_ids).all()
+
+        row_order = np.argsort(group, kind='stable')
+        labeled = actions[row_order] != -1
+        counts = np.bincount(group[row_order][labeled], minlength=len(first_rows))
+
+        return cls(
+            video_names.tolist(),
+            video_idx[first_rows],
+            secs[first_rows],
+            box_ids[first_rows].astype(np.int32),
+            scene_ids[first_rows],
+            link_ids[first_rows],
+            np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+            actions[row_order][labeled],
+            box_table,
+        )
+
+    def video_secs(self, video_idx):
+        """Sorted populated secs of a video."""
+        return self.slot_secs[
+            self.video_slot_offsets[video_idx]:self.video_slot_offsets[video_idx + 1]]
+
+    def rows_for_secs(self, video_idx, secs):
+        """Rows of the given secs of a video, in the order of `secs`."""
+        slot_start = self.video_slot_offsets[video_idx]
+        video_secs = self.video_secs(video_idx)
+        if len(video_secs) == 0:
+            return np.zeros((0,), dtype=np.int64)
+        pos = np.minimum(np.searchsorted(video_secs, secs), len(video_secs) - 1)
+        slots = slot_start + pos[video_secs[pos] == secs]
+
+        starts = self.slot_offsets[slots]
+        return concat_ranges(starts, self.slot_offsets[slots + 1] - starts)
+
+    def count_rows(self, video_idx, low_secs, high_secs):
+        """Number of rows with low_secs <= sec <= high_secs, vectorized over
+        (video_idx, low_secs, high_secs) windows."""
+        def keys(videos, secs):
+            return np.asarray(videos, dtype=np.int64) * 2**32 + secs
+
+        slot_keys = keys(self.video_idx[self.slot_offsets[:-1]], self.slot_secs)
+        low = np.searchsorted(slot_keys, keys(video_idx, low_secs))
+        high = np.searchsorted(slot_keys, keys(video_idx, np.asarray(high_secs) + 1))
+        return self.slot_offsets[high] - self.slot_offsets[low]
+
+    def row_actions(self, row):
+        return self.actions[self.action_offsets[row]:self.action_offsets[row + 1]]
+
+    def actions_for_rows(self, rows):
+        """Number of actions of each row and their concatenated action ids."""
+        starts = self.action_offsets[rows]
+        counts = self.action_offsets[rows + 1] - starts
+        return counts, self.actions[concat_ranges(starts, counts)]
+
+
+def concat_ranges(starts, lengths):
+    """Concatenation of arange(start, start + length) without a Python loop."""
+    shifts = starts - (np.cumsum(lengths) - lengths)
+    return np.repeat(shifts, lengths) + np.arange(lengths.sum())
 
 
 def load_mc_video_data(args, evaluate):
@@ -116,55 +309,196 @@ def load_mc_video_data(args, evaluate):
 
 
 def load_features(in_file_name, args):
-
-    if '@@@' in in_file_name:
-        file_names = in_file_name.split('@@@')
+    if in_file_name.endswith('.npy'):
+        features = FeatureStore.load(in_file_name)
+    elif not any(split_file_names(in_file_name)):
+        raise ValueError(
+            'No feature files in %r (--train_feature_file/--eval_feature_file)'
+            % in_file_name)
     else:
-        file_names = [in_file_name]
-
-    features = {}
-    feature_count = 0
-    for file_name in file_names:
-        is_gt = 'train_features' in file_name
-        logger.info('Loading features from {} (is GT? {})'.format(file_name, is_gt))
-        if file_name == '':
-            continue
-        with open(file_name, 'rb') as f:
-            X, boxes, meta = pickle.load(f)
-
-        for i in range(X.shape[0]):
-            box = ','.join(['%.03f' % x for x in boxes[i][1:]])
-            video_name = meta[i][0]
-            if is_gt:
-                video_name = 'GT_' + video_name
-            sec = meta[i][1]
-
-            if video_name not in features:
-                features[video_name] = {}
-
-            if sec not in features[video_name]:
-                features[video_name][sec] = {}
-
-            if box in features[video_name][sec]:
-                logger.info((video_name, sec, box,
-                             features[video_name][sec][box], X[i], i))
-            features[video_name][sec][box] = X[i]
-        feature_count += X.shape[0]
+        features = FeatureStore.from_pickle(split_file_names(in_file_name))
 
     logger.info('{} features of {} videos loaded.'.format(
-        feature_count, len(features)))
+        len(features), len(features.video_names)))
     return features
 
 
-
-def binarize(indices, num_classes=None):
-    if num_classes is None:
-        num_classes = 80
-
-    vec = np.zeros((num_classes, ))
-    for idx in indices:
-        if idx == -1:
-            continue
-
-        vec[idx] = 1
-    return vec
+def split_file_names(in_file_name):
+    if '@@@' in in_file_name:
+        return in_file_name.split('@@@')
+    return [in_file_name]
+
+
+def quantize_boxes(boxes):
+    # Same 1e-3 grid as the '%.03f' box strings.
+    return np.round(np.asarray(boxes, dtype=np.float64) * 1000.0).astype(np.int64)
+
+
+def pack_box_keys(quantized):
+    # One sortable uint64 per box, 16 bits per quantized coordinate.
+    assert quantized.size == 0 or (
+        quantized.min() >= -(1 << 15) and quantized.max() < (1 << 15)), 'box out of range'
+    shifted = (quantized + (1 << 15)).astype(np.uint64)
+    return ((shifted[:, 0] << np.uint64(48)) | (shifted[:, 1] << np.uint64(32))
+            | (shifted[:, 2] << np.uint64(16)) | shifted[:, 3])
+
+
+class BoxTable(object):
+    """Canonical integer ids for (x1, y1, x2, y2) boxes on the 1e-3 grid.
+
+    Ids index `coords`, a float32 [N, 4] array, so boxes are parsed and
+    formatted once at load time instead of per example.
+    """
+
+    def __init__(self, boxes):
+        quantized = quantize_boxes(boxes).reshape((-1, 4))
+        self.keys, first = np.unique(pack_box_keys(quantized), return_index=True)
+        self.coords = (quantized[first] / 1000.0).astype(np.float32)
+
+    def __len__(self):
+        return self.keys.shape[0]
+
+    def lookup(self, boxes):
+        """Ids of [M, 4] boxes, -1 for boxes not in the table."""
+        keys = pack_box_keys(quantize_boxes(boxes).reshape((-1, 4)))
+        if len(self) == 0:
+            return np.full(keys.shape, -1, dtype=np.int64)
+        ids = np.minimum(np.searchsorted(self.keys, keys), len(self) - 1)
+        ids[self.keys[ids] != keys] = -1
+        return ids
+
+
+def join_rows(query_keys, table_keys):
+    """For every row of `query_keys`, the index of the last equal row of
+    `table_keys`, or -1 if there is none."""
+    num_table = table_keys.shape[0]
+    keys = np.concatenate([table_keys, query_keys])
+    if keys.shape[0] == 0:
+        return np.zeros((0,), dtype=np.int64)
+    _, inverse = np.unique(keys, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    group_to_row = np.full((inverse.max() + 1,), -1, dtype=np.int64)
+    group_to_row[inverse[:num_table]] = np.arange(num_table)
+    return group_to_row[inverse[num_table:]]
+
+
+def feature_index_path(path):
+    return path[:-len('.npy')] + '.index.npz'
+
+
+class FeatureStore(object):
+    """Feature matrix [N, D] plus a (video, sec, box) index of its rows.
+
+    `features` is either an in-memory array (pickled inputs) or a read-only
+    memmap (converted `.npy` stores), so workers share the pages.
+    """
+
+    def __init__(self, features, video_names, video_idx, secs, boxes):
+        self.features = features
+        self.video_names = list(video_names)
+        self.video_idx = video_idx
+        self.secs = secs
+        self.boxes = boxes
+        self.video_name_to_idx = {
+            name: i for i, name in enumerate(self.video_names)}
+
+    def __len__(self):
+        return self.features.shape[0]
+
+    @classmethod
+    def from_pickle(cls, file_names):
+        all_X, all_names, all_secs, all_boxes = [], [], [], []
+        for file_name in file_names:
+            is_gt = 'train_features' in file_name
+            logger.info('Loading features from {} (is GT? {})'.format(file_name, is_gt))
+            if file_name == '':
+                continue
+            with open(file_name, 'rb') as f:
+                X, boxes, meta = pickle.load(f)
+
+            prefix = 'GT_' if is_gt else ''
+            all_X.append(X)
+            all_names.append(np.array([prefix + m[0] for m in meta]))
+            all_secs.append(np.array([m[1] for m in meta], dtype=np.int64))
+            all_boxes.append(np.asarray(boxes, dtype=np.float32)[:, 1:5])
+        if not all_X:
+            raise ValueError('No feature files in %r' % (file_names,))
+
+        X = all_X[0] if len(all_X) == 1 else np.concatenate(all_X)
+        video_names, video_idx = np.unique(
+            np.concatenate(all_names), return_inverse=True)
+        return cls(X, video_names.tolist(), video_idx.astype(np.int32),
+                   np.concatenate(all_secs).astype(np.int32),
+                   np.concatenate(all_boxes))
+
+    @classmethod
+    def load(cls, path):
+        logger.info('Opening feature store {}'.format(path))
+        index = np.load(feature_index_path(path))
+        return cls(np.load(path, mmap_mode='r'), index['video_names'].tolist(),
+                   index['video_idx'], index['secs'], index['boxes'])
+
+    def save(self, path, dtype=np.float32, chunk_size=65536):
+        order = np.lexsort((
+            *quantize_boxes(self.boxes).T[::-1], self.secs, self.video_idx))
+
+        out = np.lib.format.open_memmap(
+            path, mode='w+', dtype=dtype, shape=self.features.shape)
+        for start in range(0, len(order), chunk_size):
+            rows = order[start:start + chunk_size]
+            out[start:start + len(rows)] = self.features[rows]
+        out.flush()
+        del out
+
+        np.savez(
+            feature_index_path(path),
+            video_names=np.array(self.video_names),
+            video_idx=self.video_idx[order],
+            secs=self.secs[order],
+            boxes=self.boxes[order],
+        )
+        logger.info('{} features written to {}'.format(len(order), path))
+
+    def keys(self, box_table):
+        return np.stack([
+            self.video_idx.astype(np.int64),
+            self.secs.astype(np.int64),
+            box_table.lookup(self.boxes),
+        ], axis=1)
+
+    def lookup(self, video_names, video_idx, secs, box_ids, box_table):
+        """Feature rows of parallel (video, sec, box id) arrays, -1 if missing.
+
+        `video_idx` indexes the caller's `video_names`.
+        """
+        to_store_idx = np.array(
+            [self.video_name_to_idx.get(name, -1) for name in video_names] + [-1],
+            dtype=np.int64)
+        video_idx = to_store_idx[np.asarray(video_idx)]
+        query_keys = np.stack([
+            video_idx,
+            np.asarray(secs, dtype=np.int64),
+            np.asarray(box_ids, dtype=np.int64),
+        ], axis=1)
+        rows = join_rows(query_keys, self.keys(box_table))
+        rows[video_idx == -1] = -1
+        return rows
+
+    def gather(self, rows, dtype=np.float32):
+        return np.asarray(self.features[np.asarray(rows)], dtype=dtype)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Convert pickled (X, boxes, meta) features to a memory-mappable store.')
+    parser.add_argument('in_file_name', help='Pickled feature file(s), joined by @@@.')
+    parser.add_argument('out_file_name', help='Output .npy path; the index goes next to it.')
+    parser.add_argument('--dtype', default='float32', choices=['float16', 'float32'])
+    cli_args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    assert cli_args.out_file_name.endswith('.npy'), cli_args.out_file_name
+    FeatureStore.from_pickle(split_file_names(cli_args.in_file_name)).save(
+        cli_args.out_file_name, dtype=np.dtype(cli_args.dtype))
@@ -93,6 +93,9 @@ class BertConfig(PretrainedConfig):
                 The standard deviation of the truncated_normal_initializer for initializing all weight matrices.
             layer_norm_eps (:obj:`float`, optional, defaults to 1e-12):
                 The epsilon used by the layer normalization layers.
+            attention_backend (:obj:`str`, optional, defaults to "sdpa"):
+                How self-attention is computed: "sdpa" (fused kernels), "chunked" (eager attention over
+                chunks of queries) or "eager". See :class:`~transformers.modeling_bert.BertSelfAttention`.
 
         Example::
 
@@ -128,6 +131,7 @@ class BertConfig(PretrainedConfig):
         type_vocab_size=2,
         initializer_range=0.02,
         layer_norm_eps=1e-12,
+        attention_backend="sdpa",
         **kwargs
     ):
         super().__init__(**kwargs)
@@ -144,3 +148,4 @@ class BertConfig(PretrainedConfig):
         self.type_vocab_size = type_vocab_size
         self.initializer_range = initializer_range
         self.layer_norm_eps = layer_norm_eps
+        self.attention_backend = attention_backend
@@ -28,12 +28,12 @@ import pickle
 
 import torch
 from torch import nn
+import torch.nn.functional as F
 from torch.nn import CrossEntropyLoss, MSELoss
 
 from .configuration_bert import BertConfig
 from .file_utils import add_start_docstrings, add_start_docstrings_to_callable
 from .modeling_utils import PreTrainedModel, prune_linear_layer
-import random
 
 logger = logging.getLogger(__name__)
 
@@ -172,29 +172,62 @@ ACT2FN = {
 BertLayerNorm = torch.nn.LayerNorm
 
 
-def paste_embedding(inputs_embeds, masked_embedding):
+def paste_embedding(inputs_embeds, masked_embedding, masked_positions):
+    """Replaces the features at masked_positions ([B, L] bool) with the mask
+    embedding."""
+    return torch.where(masked_positions[:, :, None], masked_embedding, inputs_embeds)
 
-    # -10: masked
-    # 0: padding or empty
-    masked_entries = inputs_embeds.sum(axis=2) == (-10 * inputs_embeds.shape[2])
-    if masked_entries.sum() == 0:
-        # assert self.args.action_recognition
-        if random.random() < 0.005:
-            print("Warning assert self.args.action_recognition")
-        return inputs_embeds
 
-    if random.random() < 0.005:
-        print(masked_entries.sum())
-    assert len(masked_entries.shape) == 2
+def pack_sequences(x, packed_index):
+    """[B, L, ...] -> [T, ...]: the entries at packed_index, flat indices
+    into B * L in batch order, so each sequence's tokens stay contiguous."""
+    return x.flatten(0, 1)[packed_index]
 
-    masked_entries_expand = masked_entries.view(
-        (masked_entries.shape[0], masked_entries.shape[1], 1)
-    ).expand(-1, -1, inputs_embeds.shape[2])
 
-    inputs_embeds[masked_entries_expand] = masked_embedding.repeat(
-        inputs_embeds[masked_entries_expand].shape[0] // masked_embedding.shape[0]
-    )
-    return inputs_embeds
+def unpack_sequences(x, packed_index, batch_size, seq_length):
+    """[T, ...] -> [B, L, ...], with zeros where packed_index has no token."""
+    padded = x.new_zeros((batch_size * seq_length,) + x.shape[1:])
+    padded = padded.index_copy(0, packed_index, x)
+    return padded.view((batch_size, seq_length) + x.shape[1:])
+
+
+class FusedEmbedding(nn.Embedding):
+    """num_tables embedding tables of num_embeddings rows each, stacked in one
+    weight so that looking up one id per table and summing is a single
+    embedding_bag.
+
+    As with nn.Embedding(padding_idx=...), padding ids get no gradient. They
+    also add nothing to the sum, which only changes outputs at all-padding
+    tokens.
+    """
+
+    def __init__(self, num_tables, num_embeddings, embedding_dim, padding_idx):
+        super().__init__(num_tables * num_embeddings, embedding_dim)
+        self.table_size = num_embeddings
+        self.table_padding_idx = padding_idx
+        # Row offsets of each `tables` combination, built on first use.
+        self._offsets = {}
+
+    def forward(self, ids, tables):
+        """Sum of the embeddings of [..., k] ids, looked up in the k tables
+        listed in `tables`."""
+        key = (tuple(tables), ids.device)
+        offsets = self._offsets.get(key)
+        if offsets is None:
+            offsets = torch.tensor(tables, device=ids.device) * self.table_size
+            self._offsets[key] = offsets
+        flat_ids = ids.view(-1, len(tables))
+        # Every padding id points at the padding row of table 0, which
+        # embedding_bag leaves out.
+        flat_ids = torch.where(
+            flat_ids == self.table_padding_idx,
+            self.table_padding_idx,
+            flat_ids + offsets,
+        )
+        embeddings = F.embedding_bag(
+            flat_ids, self.weight, mode="sum", padding_idx=self.table_padding_idx
+        )
+        return embeddings.view(ids.shape[:-1] + (self.embedding_dim,))
 
 
 class BertEmbeddings(nn.Module):
@@ -218,6 +251,14 @@ class BertEmbeddings(nn.Module):
         self.feat_dim = config.feat_dim
         logger.info("self.feat_dim = {}".format(self.feat_dim))
 
+        # Position, scene and link embeddings, set up by subclasses: the names
+        # of the tables in id_embeddings, a FusedEmbedding. Each table is saved
+        # and loaded as <name>.weight, as if it were its own nn.Embedding.
+        self.id_embedding_names = []
+        self.id_embeddings = None
+        self._register_state_dict_hook(split_id_embeddings)
+        self._register_load_state_dict_pre_hook(stack_id_embeddings, with_module=True)
+
     def forward(
         self,
         input_ids=None,
@@ -231,6 +272,7 @@ class BertEmbeddings(nn.Module):
         center_position_ids=None,
         inputs_embeds=None,
         spatial_codes=None,
+        masked_positions=None,
     ):
         if input_ids is not None:
             input_shape = input_ids.size()
@@ -245,74 +287,107 @@ class BertEmbeddings(nn.Module):
         if token_type_ids is None:
             token_type_ids = torch.zeros(input_shape, dtype=torch.long, device=device)
 
-        if self.args.mask_sep:
+        if masked_positions is not None and self.args.mask_sep:
             start = 0
             for mask_emb in self.masked_embedding:
                 cur_dim = mask_emb.shape[0]
                 inputs_embeds[:, :, start : start + cur_dim] = paste_embedding(
                     inputs_embeds[:, :, start : start + cur_dim],
                     mask_emb,
+                    masked_positions,
                 )
                 start += cur_dim
 
-        else:
+        elif masked_positions is not None and not self.args.precompute_reduction:
             inputs_embeds[:, :, : self.args.action_feat_dim] = paste_embedding(
                 inputs_embeds[:, :, : self.args.action_feat_dim],
                 self.masked_embedding[0]
                 if isinstance(self.masked_embedding, nn.ParameterList)
                 else self.masked_embedding,
+                masked_positions,
             )
 
         # token_type_embeddings = self.token_type_embeddings(token_type_ids)
         assert token_type_ids.sum() == 0
 
-        embeddings = inputs_embeds
         # token_type_embeddings +)
 
-        if self.word_embeddings is None:
-            embeddings = self.reduction(embeddings)
+        if self.args.precompute_reduction:
+            # inputs_embeds holds reduction(features) after the features
+            # themselves (see VideoDataset.cache_reduction), so masked tokens
+            # take the reduced mask embedding.
+            embeddings = inputs_embeds[..., self.feat_dim :]
+            if masked_positions is not None:
+                embeddings = paste_embedding(
+                    embeddings,
+                    self.reduction(self.masked_embedding[0]),
+                    masked_positions,
+                )
+            else:
+                embeddings = embeddings.clone()
+        elif self.word_embeddings is None:
+            embeddings = self.reduction(inputs_embeds)
+        else:
+            embeddings = inputs_embeds.clone()
 
+        # Everything else is summed into embeddings in place.
         if spatial_codes is not None:
-            spatial_embed = self.spatial_embeddings(spatial_codes)
-            embeddings = embeddings + spatial_embed
-
-        if inc_position_ids is not None:
-            inc_position_embeddings = self.inc_position_embeddings(inc_position_ids)
-            dec_position_embeddings = self.dec_position_embeddings(dec_position_ids)
-            center_position_embeddings = self.center_position_embeddings(
-                center_position_ids
+            embeddings += self.spatial_embeddings(spatial_codes)
+
+        ids = {
+            "inc_position_embeddings": inc_position_ids,
+            "dec_position_embeddings": dec_position_ids,
+            "center_position_embeddings": center_position_ids,
+            "inc_scene_embeddings": inc_scene_ids,
+            "dec_scene_embeddings": dec_scene_ids,
+            "center_scene_embeddings": center_scene_ids,
+            "link_embeddings": link_ids,
+        }
+        names = [name for name in self.id_embedding_names if ids[name] is not None]
+        if names:
+            embeddings += self.id_embeddings(
+                torch.stack([ids[name] for name in names], dim=-1),
+                [self.id_embedding_names.index(name) for name in names],
             )
 
-            embeddings = (
-                embeddings
-                + inc_position_embeddings
-                + dec_position_embeddings
-                + center_position_embeddings
-            )
+        embeddings = self.LayerNorm(embeddings)
 
-        if inc_scene_ids is not None:
-            inc_scene_embeddings = self.inc_scene_embeddings(inc_scene_ids)
-            dec_scene_embeddings = self.dec_scene_embeddings(dec_scene_ids)
-            center_scene_embeddings = self.center_scene_embeddings(center_scene_ids)
+        embeddings = self.dropout(embeddings)
+        return embeddings
 
-            embeddings = (
-                embeddings
-                + inc_scene_embeddings
-                + dec_scene_embeddings
-                + center_scene_embeddings
-            )
 
-        if link_ids is not None:
-            link_embeddings = self.link_embeddings(link_ids)
-            embeddings = embeddings + link_embeddings
+def split_id_embeddings(module, state_dict, prefix, local_metadata):
+    """State dict hook of BertEmbeddings: saves each id embedding table
+    under its own name."""
+    weight = state_dict.pop(prefix + "id_embeddings.weight", None)
+    if weight is not None:
+        tables = weight.split(module.id_embeddings.table_size)
+        for name, table in zip(module.id_embedding_names, tables):
+            state_dict[prefix + name + ".weight"] = table
 
-        embeddings = self.LayerNorm(embeddings)
 
-        embeddings = self.dropout(embeddings)
-        return embeddings
+def stack_id_embeddings(module, state_dict, prefix, *args):
+    """Load state dict pre-hook of BertEmbeddings: stacks the tables saved
+    by split_id_embeddings (or by separate nn.Embedding modules)."""
+    keys = [prefix + name + ".weight" for name in module.id_embedding_names]
+    if keys and all(key in state_dict for key in keys):
+        state_dict[prefix + "id_embeddings.weight"] = torch.cat(
+            [state_dict.pop(key) for key in keys]
+        )
 
 
 class BertSelfAttention(nn.Module):
+    """Multi-head attention with a choice of backend (config.attention_backend):
+
+    "sdpa" uses torch's fused scaled_dot_product_attention, "chunked" goes
+    through the queries query_chunk_size at a time so only [B, H, chunk, L]
+    scores exist at once, and "eager" materializes all [B, H, L, L]
+    probabilities. Eager attention also runs whenever the probabilities are
+    needed, for output_attentions or a head_mask.
+    """
+
+    query_chunk_size = 64
+
     def __init__(self, config):
         super().__init__()
         if config.hidden_size % config.num_attention_heads != 0:
@@ -332,6 +407,15 @@ class BertSelfAttention(nn.Module):
 
         self.dropout = nn.Dropout(config.attention_probs_dropout_prob)
 
+        self.attention_backend = getattr(config, "attention_backend", "eager")
+        if self.attention_backend == "sdpa" and not hasattr(
+            F, "scaled_dot_product_attention"
+        ):
+            logger.warning(
+                "scaled_dot_product_attention needs torch>=2.0, using chunked"
+            )
+            self.attention_backend = "chunked"
+
     def transpose_for_scores(self, x):
         new_x_shape = x.size()[:-1] + (
             self.num_attention_heads,
@@ -347,7 +431,12 @@ class BertSelfAttention(nn.Module):
         head_mask=None,
         encoder_hidden_states=None,
         encoder_attention_mask=None,
+        packed_index=None,
     ):
+        """With packed_index, hidden_states holds the [T, hidden] tokens of the
+        batch (see BertModel.forward) and attention runs per sequence: queries,
+        keys and values are laid out on the [B, L] grid of attention_mask only
+        for the attention product itself."""
         mixed_query_layer = self.query(hidden_states)
 
         # If this is instantiated as a cross-attention module, the keys
@@ -361,10 +450,55 @@ class BertSelfAttention(nn.Module):
             mixed_key_layer = self.key(hidden_states)
             mixed_value_layer = self.value(hidden_states)
 
+        if packed_index is not None:
+            batch_size, seq_length = attention_mask.shape[0], attention_mask.shape[-1]
+            mixed_query_layer, mixed_key_layer, mixed_value_layer = [
+                unpack_sequences(x, packed_index, batch_size, seq_length)
+                for x in (mixed_query_layer, mixed_key_layer, mixed_value_layer)
+            ]
+
         query_layer = self.transpose_for_scores(mixed_query_layer)
         key_layer = self.transpose_for_scores(mixed_key_layer)
         value_layer = self.transpose_for_scores(mixed_value_layer)
 
+        if (
+            self.output_attentions
+            or head_mask is not None
+            or self.attention_backend == "eager"
+        ):
+            context_layer, attention_probs = self.eager_attention(
+                query_layer, key_layer, value_layer, attention_mask, head_mask
+            )
+        elif self.attention_backend == "sdpa":
+            context_layer = F.scaled_dot_product_attention(
+                query_layer,
+                key_layer,
+                value_layer,
+                attn_mask=attention_mask,
+                dropout_p=self.dropout.p if self.training else 0.0,
+            )
+        else:
+            context_layer = self.chunked_attention(
+                query_layer, key_layer, value_layer, attention_mask
+            )
+
+        context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
+        new_context_layer_shape = context_layer.size()[:-2] + (self.all_head_size,)
+        context_layer = context_layer.view(*new_context_layer_shape)
+        if packed_index is not None:
+            context_layer = pack_sequences(context_layer, packed_index)
+
+        outputs = (
+            (context_layer, attention_probs)
+            if self.output_attentions
+            else (context_layer,)
+        )
+        return outputs
+
+    def eager_attention(
+        self, query_layer, key_layer, value_layer, attention_mask, head_mask=None
+    ):
+        """Context layer and attention probabilities of [B, H, L, D] inputs."""
         # Take the dot product between "query" and "key" to get the raw attention scores.
         attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
         attention_scores = attention_scores / math.sqrt(self.attention_head_size)
@@ -373,7 +507,7 @@ class BertSelfAttention(nn.Module):
             attention_scores = attention_scores + attention_mask
 
         # Normalize the attention scores to probabilities.
-        attention_probs = nn.Softmax(dim=-1)(attention_scores)
+        attention_probs = attention_scores.softmax(dim=-1)
 
         # This is actually dropping out entire tokens to attend to, which might
         # seem a bit unusual, but is taken from the original Transformer paper.
@@ -383,18 +517,22 @@ class BertSelfAttention(nn.Module):
         if head_mask is not None:
             attention_probs = attention_probs * head_mask
 
-        context_layer = torch.matmul(attention_probs, value_layer)
-
-        context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
-        new_context_layer_shape = context_layer.size()[:-2] + (self.all_head_size,)
-        context_layer = context_layer.view(*new_context_layer_shape)
-
-        outputs = (
-            (context_layer, attention_probs)
-            if self.output_attentions
-            else (context_layer,)
-        )
-        return outputs
+        return torch.matmul(attention_probs, value_layer), attention_probs
+
+    def chunked_attention(self, query_layer, key_layer, value_layer, attention_mask):
+        """Context layer of eager attention, query_chunk_size queries at a time."""
+        context_layers = []
+        for start in range(0, query_layer.shape[2], self.query_chunk_size):
+            end = start + self.query_chunk_size
+            chunk_mask = attention_mask
+            if attention_mask is not None and attention_mask.shape[-2] > 1:
+                chunk_mask = attention_mask[..., start:end, :]
+            context_layers.append(
+                self.eager_attention(
+                    query_layer[:, :, start:end], key_layer, value_layer, chunk_mask
+                )[0]
+            )
+        return torch.cat(context_layers, dim=2)
 
 
 class BertSelfOutput(nn.Module):
@@ -452,6 +590,7 @@ class BertAttention(nn.Module):
         head_mask=None,
         encoder_hidden_states=None,
         encoder_attention_mask=None,
+        packed_index=None,
     ):
         self_outputs = self.self(
             hidden_states,
@@ -459,6 +598,7 @@ class BertAttention(nn.Module):
             head_mask,
             encoder_hidden_states,
             encoder_attention_mask,
+            packed_index,
         )
         attention_output = self.output(self_outputs[0], hidden_states)
         outputs = (attention_output,) + self_outputs[
@@ -513,9 +653,10 @@ class BertLayer(nn.Module):
         head_mask=None,
         encoder_hidden_states=None,
         encoder_attention_mask=None,
+        packed_index=None,
     ):
         self_attention_outputs = self.attention(
-            hidden_states, attention_mask, head_mask
+            hidden_states, attention_mask, head_mask, packed_index=packed_index
         )
         attention_output = self_attention_outputs[0]
         outputs = self_attention_outputs[
@@ -546,6 +687,7 @@ class BertEncoder(nn.Module):
         head_mask=None,
         encoder_hidden_states=None,
         encoder_attention_mask=None,
+        packed_index=None,
     ):
         all_hidden_states = ()
         all_attentions = ()
@@ -559,6 +701,7 @@ class BertEncoder(nn.Module):
                 head_mask[i],
                 encoder_hidden_states,
                 encoder_attention_mask,
+                packed_index,
             )
             hidden_states = layer_outputs[0]
 
@@ -797,8 +940,15 @@ class BertModel(BertPreTrainedModel):
         spatial_codes=None,
         encoder_hidden_states=None,
         encoder_attention_mask=None,
+        masked_positions=None,
+        packed_index=None,
     ):
         r"""
+        packed_index (:obj:`torch.LongTensor` of shape :obj:`(num_tokens,)`, `optional`, defaults to :obj:`None`):
+            Flat indices into ``batch_size * sequence_length`` of the tokens to run the model on, usually those
+            where the 2D ``attention_mask`` is 1. The embeddings and all dense layers then only see these
+            ``num_tokens`` tokens, and hidden states are returned packed, of shape ``(num_tokens, hidden_size)``.
+
         Return:
             :obj:`tuple(torch.FloatTensor)` comprising various elements depending on the configuration (:class:`~transformers.BertConfig`) and inputs:
             last_hidden_state (:obj:`torch.FloatTensor` of shape :obj:`(batch_size, sequence_length, hidden_size)`):
@@ -954,8 +1104,7 @@ class BertModel(BertPreTrainedModel):
         else:
             head_mask = [None] * self.config.num_hidden_layers
 
-        embedding_output = self.embeddings(
-            # input_ids=input_ids,
+        embedding_inputs = dict(
             inc_scene_ids=inc_scene_ids,
             dec_scene_ids=dec_scene_ids,
             center_scene_ids=center_scene_ids,
@@ -966,13 +1115,29 @@ class BertModel(BertPreTrainedModel):
             token_type_ids=token_type_ids,
             inputs_embeds=inputs_embeds,
             spatial_codes=spatial_codes,
+            masked_positions=masked_positions,
         )
+        if packed_index is not None:
+            if self.config.is_decoder or attention_mask.dim() != 2:
+                raise ValueError(
+                    "packed_index needs an encoder and a 2D attention_mask"
+                )
+            # The packed tokens go through the embeddings as one long sequence.
+            embedding_inputs = {
+                k: None if v is None else pack_sequences(v, packed_index)[None]
+                for k, v in embedding_inputs.items()
+            }
+
+        embedding_output = self.embeddings(**embedding_inputs)
+        if packed_index is not None:
+            embedding_output = embedding_output[0]
         encoder_outputs = self.encoder(
             embedding_output,
             attention_mask=extended_attention_mask,
             head_mask=head_mask,
             encoder_hidden_states=encoder_hidden_states,
             encoder_attention_mask=encoder_extended_attention_mask,
+            packed_index=packed_index,
         )
         sequence_output = encoder_outputs[0]
         outputs = (sequence_output,) + encoder_outputs[
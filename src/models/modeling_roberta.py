@@ -36,10 +36,13 @@ from .file_utils import add_start_docstrings, add_start_docstrings_to_callable
 from .modeling_bert import (
     BertEmbeddings,
     BertLayerNorm,
+    FusedEmbedding,
     BertModel,
     BertPreTrainedModel,
     gelu,
     BertPooler,
+    pack_sequences,
+    unpack_sequences,
 )
 
 ROBERTA_PRETRAINED_MODEL_ARCHIVE_MAP = {}
@@ -65,35 +68,22 @@ class RobertaEmbeddings(BertEmbeddings):
         self.word_embeddings = None
 
         if not args.no_pos_ids:
-            (
-                self.inc_position_embeddings,
-                self.dec_position_embeddings,
-                self.center_position_embeddings,
-            ) = [
-                nn.Embedding(
-                    config.max_position_embeddings,
-                    embed_hidden_size,
-                    padding_idx=self.padding_idx,
-                )
-                for _ in range(3)
+            self.id_embedding_names += [
+                "inc_position_embeddings",
+                "dec_position_embeddings",
+                "center_position_embeddings",
             ]
-
         if not args.no_scene_ids:
-            (
-                self.inc_scene_embeddings,
-                self.dec_scene_embeddings,
-                self.center_scene_embeddings,
-            ) = [
-                nn.Embedding(
-                    config.max_position_embeddings,
-                    embed_hidden_size,
-                    padding_idx=self.padding_idx,
-                )
-                for _ in range(3)
+            self.id_embedding_names += [
+                "inc_scene_embeddings",
+                "dec_scene_embeddings",
+                "center_scene_embeddings",
             ]
-
         if not args.no_link_ids:
-            self.link_embeddings = nn.Embedding(
+            self.id_embedding_names += ["link_embeddings"]
+        if self.id_embedding_names:
+            self.id_embeddings = FusedEmbedding(
+                len(self.id_embedding_names),
                 config.max_position_embeddings,
                 embed_hidden_size,
                 padding_idx=self.padding_idx,
@@ -123,6 +113,7 @@ class RobertaEmbeddings(BertEmbeddings):
         center_position_ids=None,
         inputs_embeds=None,
         spatial_codes=None,
+        masked_positions=None,
     ):
         # if position_ids is None:
         #     assert False
@@ -143,6 +134,7 @@ class RobertaEmbeddings(BertEmbeddings):
             center_position_ids=center_position_ids,
             inputs_embeds=inputs_embeds,
             spatial_codes=spatial_codes,
+            masked_positions=masked_positions,
         )
 
     def create_position_ids_from_input_ids(self, x):
@@ -225,6 +217,7 @@ class RobertaForMaskedLM(BertPreTrainedModel):
         config.num_attention_heads = args.num_attention_heads
         config.feat_dim = args.feat_dim
         config.vocab_size = None
+        config.attention_backend = args.attention_backend
         logger.warn("+" * 10)
         logger.warn(
             "Setting config.max_position_embeddings to {}".format(
@@ -273,9 +266,11 @@ class RobertaForMaskedLM(BertPreTrainedModel):
         action_labels=None,
         long_term_labels=None,
         target_locations=None,
+        masked_positions=None,
         secs=None,
         boxes=None,
         args=None,
+        output_head_hidden=False,
     ):
         r"""
             masked_lm_labels (:obj:`torch.LongTensor` of shape :obj:`(batch_size, sequence_length)`, `optional`, defaults to :obj:`None`):
@@ -317,6 +312,12 @@ class RobertaForMaskedLM(BertPreTrainedModel):
         assert inc_position_ids is not None
         attention_mask = inc_position_ids != 1
 
+        # With packed_encoder, only the real tokens go through the encoder and
+        # the head; the predictions are laid out on the [B, L] grid again.
+        packed_index = None
+        if self.args.packed_encoder:
+            packed_index = attention_mask.flatten().nonzero().squeeze(1)
+
         outputs = self.roberta(  ###############   STT-2 #########
             inc_scene_ids=inc_scene_ids,
             dec_scene_ids=dec_scene_ids,
@@ -330,6 +331,8 @@ class RobertaForMaskedLM(BertPreTrainedModel):
             head_mask=head_mask,
             inputs_embeds=inputs_embeds,
             spatial_codes=spatial_codes,
+            masked_positions=masked_positions,
+            packed_index=packed_index,
         )
         sequence_output = outputs[0]
 
@@ -338,10 +341,23 @@ class RobertaForMaskedLM(BertPreTrainedModel):
 
         ignore = ~target_locations
 
-        prediction_scores = self.action_lm_head(
-            sequence_output, outputs_embeds[:, :, :2304]
-        )
+        features_2 = outputs_embeds[:, :, :2304]
+        if packed_index is not None:
+            features_2 = pack_sequences(features_2, packed_index)
+        head_hidden = self.action_lm_head.hidden(sequence_output)
+        prediction_scores = self.action_lm_head.decode(head_hidden, features_2)
+        if packed_index is not None:
+            prediction_scores = unpack_sequences(
+                prediction_scores, packed_index, *attention_mask.shape
+            )
+            if output_head_hidden:
+                head_hidden = unpack_sequences(
+                    head_hidden, packed_index, *attention_mask.shape
+                )
         all_outputs["pred"] = prediction_scores
+        if output_head_hidden:
+            # Input of the head's decoder, for the linear probe cache in run.py.
+            all_outputs["head_hidden"] = head_hidden
 
         masked_lm_loss = MaskedBCEWithLogitsLoss(
             prediction_scores.view(-1, self.args.num_action_classes),
@@ -372,10 +388,15 @@ class ActionRecognitionHead(nn.Module):
         self.bias = self.decoder.bias
 
     def forward(self, features, features_2=None, **kwargs):
+        return self.decode(self.hidden(features), features_2)
 
+    def hidden(self, features):
         x = self.dense(features)
         x = gelu(x)
         x = self.layer_norm(x)
+        return x
+
+    def decode(self, x, features_2=None):
         x = self.decoder(x)
 
         if features_2 is not None:
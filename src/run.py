@@ -24,12 +24,12 @@ GPT and GPT-2 are fine-tuned using a causal language modeling (CLM) loss while B
 using a masked language modeling (MLM) loss.
 """
 
-
 import argparse
+import functools
 import glob
+import hashlib
 import logging
 import os
-import pickle
 import random
 import re
 import shutil
@@ -39,8 +39,13 @@ import time
 import numpy as np
 import torch
 import torch.nn as nn
-from torch.nn.utils.rnn import pad_sequence
-from torch.utils.data import DataLoader, Dataset, RandomSampler, SequentialSampler
+from torch.utils.data import (
+    DataLoader,
+    Dataset,
+    RandomSampler,
+    Sampler,
+    SequentialSampler,
+)
 from torch.utils.data.distributed import DistributedSampler
 from tqdm import tqdm, trange
 
@@ -53,9 +58,7 @@ from models import (
     get_linear_schedule_with_warmup,
 )
 from data import video_data_helper
-from data.video_data_helper import binarize
-from utils.ava_eval_helper import evaluate_ava
-
+from utils import ava_eval_helper
 
 logger = logging.getLogger(__name__)
 
@@ -64,36 +67,290 @@ MODEL_CLASSES = {
     "roberta": (RobertaConfig, RobertaForMaskedLM),
 }
 
-ZERO_FEAT2304 = np.zeros((2304,))
-
 EVAL_START_SEC = 902  # inclusive
 EVAL_END_SEC = 1799  # not inclusive
 
 
-with open(
-    "/home/s222126678/Documents/lvu_trans/data/ava/slowfast_baseline_outputs/ava_eval_data.pkl",
-    "rb",
-) as f:
-    (
-        excluded_keys,
-        class_whitelist,
-        categories,
-        groundtruth,
-        video_idx_to_name,
-    ) = pickle.load(f)
-with open(
-    "/home/s222126678/Documents/lvu_trans/data/ava/slowfast_baseline_outputs/predictions-29.4.pkl",
-    "rb",
-) as f:
-    (all_preds, all_ori_boxes, all_metadata) = pickle.load(f)
-video_name_to_idx = {
-    video_idx_to_name[key]: key for key in range(len(video_idx_to_name))
-}
-logger.info(video_name_to_idx)
-logger.info(video_idx_to_name)
+AVA_BASELINE_DIR = (
+    "/home/s222126678/Documents/lvu_trans/data/ava/slowfast_baseline_outputs"
+)
 
 proj_W = None
 proj_b = None
+mask_generator = None
+
+
+class AvaEvalContext(object):
+    """AVA groundtruth, labelmap and the short-term baseline predictions whose
+    scores `evaluate_action_recognition` replaces."""
+
+    def __init__(self, eval_data_file, predictions_file):
+        (
+            self.excluded_keys,
+            self.class_whitelist,
+            self.categories,
+            self.groundtruth,
+            self.video_idx_to_name,
+        ) = ava_eval_helper.load_eval_data(eval_data_file)
+        (
+            self.preds,
+            self.ori_boxes,
+            self.metadata,
+        ) = ava_eval_helper.load_predictions(predictions_file)
+        self.video_name_to_idx = {
+            name: idx for idx, name in enumerate(self.video_idx_to_name)
+        }
+        self.keys = None
+
+    def prediction_keys(self, box_table):
+        """Unique (video_idx, sec, box id) keys [K, 3] of the baseline
+        prediction rows, and the index into them of every row."""
+        if self.keys is None:
+            keys = np.stack(
+                [
+                    self.metadata[:, 0].astype(np.int64),
+                    self.metadata[:, 1].astype(np.int64),
+                    box_table.lookup(self.ori_boxes[:, 1:]),
+                ],
+                axis=1,
+            )
+            self.keys, self.row_keys = np.unique(keys, axis=0, return_inverse=True)
+            self.row_keys = self.row_keys.reshape(-1)
+        return self.keys, self.row_keys
+
+
+@functools.lru_cache(maxsize=None)
+def get_ava_eval_context(eval_data_file, predictions_file):
+    """Loads the AVA eval context on first use and caches it for the run."""
+    logger.info("Loading AVA eval data from %s", eval_data_file)
+    return AvaEvalContext(eval_data_file, predictions_file)
+
+
+def make_spans(video_idx, center_secs, tail_secs):
+    """int32 [N, 3] rows of (video_idx, center_sec, tail_sec), -1 if unused."""
+    secs = center_secs if center_secs is not None else tail_secs
+    spans = np.full((len(secs), 3), -1, dtype=np.int32)
+    spans[:, 0] = video_idx
+    spans[:, 1 if center_secs is not None else 2] = secs
+    return spans
+
+
+class FeatureRing(object):
+    """Preallocated feature buffers of max_tokens * D that [B, L, D] batches
+    with B * L <= max_tokens are built in.
+
+    Each DataLoader worker cycles through its own slots, so a slot is only
+    refilled once the batches queued after it have been taken; loader_kwargs
+    gives the DataLoader the prefetch_factor this relies on. With workers the
+    slots live in shared memory and reach the trainer without a copy; without
+    workers they are pinned so they go to the GPU directly. Larger batches,
+    e.g. from retried spans, get a fresh buffer.
+    """
+
+    def __init__(self, max_tokens, dim, dtype, num_workers, prefetch_factor=2):
+        self.max_tokens = max_tokens
+        self.dim = dim
+        self.num_workers = num_workers
+        self.prefetch_factor = prefetch_factor
+        # The batch being built, the prefetched ones, and the one in use.
+        self.slots_per_worker = prefetch_factor + 2
+        self.buffers = torch.zeros(
+            (max(1, num_workers) * self.slots_per_worker, max_tokens * dim),
+            dtype=dtype,
+        )
+        if num_workers > 0:
+            self.buffers.share_memory_()
+        elif torch.cuda.is_available():
+            self.buffers = self.buffers.pin_memory()
+        self.step = 0
+        logger.info(
+            "Feature ring: %d slots of %d tokens x %d, %.2f GB",
+            self.buffers.shape[0],
+            max_tokens,
+            dim,
+            self.buffers.numel() * self.buffers.element_size() / 1e9,
+        )
+
+    def loader_kwargs(self):
+        """DataLoader arguments matching the ring. Pinning shared slots would
+        copy every batch once more, so only the worker-less ring is pinned."""
+        if self.num_workers == 0:
+            return dict(num_workers=0, pin_memory=True)
+        return dict(
+            num_workers=self.num_workers,
+            prefetch_factor=self.prefetch_factor,
+            pin_memory=False,
+        )
+
+    def next_buffer(self, batch_size, max_len):
+        """Zeroed [batch_size, max_len, D] view of the next slot."""
+        dim = self.dim
+        if batch_size * max_len > self.max_tokens:
+            return torch.zeros((batch_size, max_len, dim), dtype=self.buffers.dtype)
+
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id = 0 if worker_info is None else worker_info.id
+        slot = worker_id * self.slots_per_worker + self.step % self.slots_per_worker
+        self.step += 1
+
+        buffer = self.buffers[slot, : batch_size * max_len * dim]
+        return buffer.zero_().view(batch_size, max_len, dim)
+
+
+class LengthBucketBatchSampler(Sampler):
+    """Batches of items with similar token counts.
+
+    Items are ordered by length bucket (quantiles of `lengths`, or the exact
+    lengths without num_buckets) and cut into batches of batch_size, so at
+    most num_buckets - 1 batches mix buckets. With shuffle, items are in
+    random order within their bucket and batches in random order; with
+    num_samples, each pass draws that many items with replacement instead of
+    taking every item once.
+    """
+
+    def __init__(self, lengths, batch_size, num_buckets, shuffle, num_samples=None):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.num_samples = num_samples
+
+        if num_buckets:
+            edges = np.quantile(lengths, np.linspace(0, 1, num_buckets + 1)[1:-1])
+            self.buckets = np.searchsorted(edges, lengths, side="right")
+        else:
+            self.buckets = lengths
+
+    def __len__(self):
+        num_items = len(self.lengths) if self.num_samples is None else self.num_samples
+        return (num_items + self.batch_size - 1) // self.batch_size
+
+    def max_batch_tokens(self):
+        """Upper bound on batch_size * max_len of the batches."""
+        return self.batch_size * int(self.lengths.max())
+
+    def split(self, items):
+        return np.array_split(
+            items, np.arange(self.batch_size, len(items), self.batch_size)
+        )
+
+    def batch_items(self, items):
+        if self.shuffle:
+            order = np.lexsort((torch.rand(len(items)).numpy(), self.buckets[items]))
+        else:
+            order = np.argsort(self.buckets[items], kind="stable")
+        return self.split(items[order])
+
+    def draw_batches(self):
+        if self.num_samples is None:
+            items = np.arange(len(self.lengths))
+        else:
+            items = torch.randint(len(self.lengths), (self.num_samples,)).numpy()
+        return items, self.batch_items(items)
+
+    def __iter__(self):
+        items, batches = self.draw_batches()
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches)).tolist()]
+
+        logger.info(
+            "Length buckets: %d batches, %.1f%% of padded tokens are real "
+            "(%.1f%% unbucketed)",
+            len(batches),
+            100.0 * padding_efficiency(self.lengths, batches),
+            100.0 * padding_efficiency(self.lengths, self.split(items)),
+        )
+        for batch in batches:
+            yield batch.tolist()
+
+
+class TokenBudgetBatchSampler(LengthBucketBatchSampler):
+    """LengthBucketBatchSampler whose batches are filled up to a budget
+    instead of a fixed number of items.
+
+    A batch of B items padded to length L costs B * L padded tokens, or with
+    attention_cost B * L * L, measured against max_tokens sequences of
+    max_len; attention_cost batches also hold at most max_tokens real tokens,
+    so short items do not pile up. Items that alone exceed the budget get a
+    batch of their own.
+
+    Training passes (num_samples) yield a fixed number of batches, the number
+    needed to pack num_samples items of the lengths' distribution, so step
+    counts and schedules can be planned from len().
+    """
+
+    def __init__(
+        self,
+        lengths,
+        max_tokens,
+        num_buckets,
+        shuffle,
+        num_samples=None,
+        attention_cost=False,
+        max_len=None,
+    ):
+        super().__init__(lengths, None, num_buckets, shuffle, num_samples)
+        self.attention_cost = attention_cost
+        self.max_tokens = max_tokens
+        self.budget = max_tokens * max_len if attention_cost else max_tokens
+
+        all_items = np.argsort(self.buckets, kind="stable")
+        num_batches = len(self.split(all_items))
+        if num_samples is not None:
+            num_batches = max(1, round(num_samples * num_batches / len(lengths)))
+        self.num_batches = num_batches
+
+    def __len__(self):
+        return self.num_batches
+
+    def cost(self, batch_size, max_len):
+        if self.attention_cost:
+            return batch_size * max_len * max_len
+        return batch_size * max_len
+
+    def max_batch_tokens(self):
+        lengths = np.unique(self.lengths)
+        batch_sizes = np.maximum(1, self.budget // self.cost(1, lengths))
+        # The other items of a batch hold at least the shortest length each.
+        batch_sizes = np.minimum(
+            batch_sizes, np.maximum(1, 1 + (self.max_tokens - lengths) // lengths[0])
+        )
+        return int((batch_sizes * lengths).max())
+
+    def split(self, items):
+        """Greedily cuts items, in order, into batches within the budget."""
+        starts = [0]
+        max_len = 0
+        num_tokens = 0
+        for i, length in enumerate(self.lengths[items].tolist()):
+            max_len = max(max_len, length)
+            num_tokens += length
+            if i > starts[-1] and (
+                self.cost(i + 1 - starts[-1], max_len) > self.budget
+                or num_tokens > self.max_tokens
+            ):
+                starts.append(i)
+                max_len = length
+                num_tokens = length
+        return np.split(items, starts[1:])
+
+    def draw_batches(self):
+        if self.num_samples is None:
+            return super().draw_batches()
+
+        # Draw until the batches for a pass are full, then drop the rest.
+        items, batches = [], []
+        while len(batches) < self.num_batches:
+            drawn, drawn_batches = super().draw_batches()
+            items.append(drawn)
+            batches.extend(drawn_batches)
+        return np.concatenate(items), batches[: self.num_batches]
+
+
+def padding_efficiency(lengths, batches):
+    """Fraction of real tokens when each batch is padded to its longest item."""
+    real = sum(int(lengths[batch].sum()) for batch in batches)
+    padded = sum(len(batch) * int(lengths[batch].max()) for batch in batches)
+    return real / max(padded, 1)
 
 
 class VideoDataset(Dataset):
@@ -110,219 +367,506 @@ class VideoDataset(Dataset):
             args.eval_data_file if evaluate else args.train_data_file,
             args,
         )
+        self.box_table = self.videos.box_table
         self.args = args
-        self.spans = []
-        for video_name in self.videos.keys():
-            v = self.videos[video_name]
-            # for action recognition only, both train and test use 15 min only.
-            for center_sec in range(EVAL_START_SEC, EVAL_END_SEC):
-                if (
-                    sum(
-                        [
-                            sec in v.keys()
-                            for sec in range(
-                                center_sec - self.secs_per_example // 2,
-                                center_sec + self.secs_per_example // 2,
-                            )
-                        ]
-                    )
-                    > 0
-                ):
-                    self.spans.append((video_name, center_sec, None))
-        if evaluate:
-            self.spans = self.spans * args.eval_sample_x
+        self.join_features()
+        self.feature_ring = None
+        # Set by cache_reduction.
+        self.reduced_features = None
+        self.reduction_bias = None
+        # Set by length_bucket_sampler: training items are then span indices
+        # drawn by the sampler instead of placeholders.
+        self.items_are_spans = False
+
+        # Shared memory, so DataLoader workers map the spans instead of
+        # receiving pickled copies.
+        spans, self.num_center_spans = self.load_spans()
+        self.spans = torch.from_numpy(spans).share_memory_()
+        self.num_span_videos = len(np.unique(spans[:, 0]))
+
+        print(self.num_span_videos, "videos in spans in total")
+        print(len(self.videos.video_names), "video data loaded in total")
+
+    def load_spans(self):
+        """Spans from the span index in output_dir, built on first use.
+
+        The index file is keyed by the data files and the span settings.
+        """
+        args = self.args
+        data_file = args.eval_data_file if self.evaluate else args.train_data_file
+        key = {
+            "data_files": [
+                (f, os.stat(f).st_mtime_ns, os.stat(f).st_size)
+                for f in video_data_helper.split_file_names(data_file)
+                if f
+            ],
+            "secs_per_example": self.secs_per_example,
+            "gap": self.span_gap(),
+            "eval_secs": (EVAL_START_SEC, EVAL_END_SEC),
+        }
+        span_file = os.path.join(
+            args.output_dir,
+            "spans_{}.npz".format(
+                hashlib.md5(repr(key).encode("utf-8")).hexdigest()[:12]
+            ),
+        )
+
+        if os.path.exists(span_file) and not args.overwrite_cache:
+            with np.load(span_file) as f:
+                if f["video_names"].tolist() == self.videos.video_names:
+                    logger.info("Loading span index from %s", span_file)
+                    return f["spans"], int(f["num_center_spans"])
+            logger.warning("Span index %s is stale, rebuilding", span_file)
+
+        spans, num_center_spans = self.build_spans()
+        try:
+            os.makedirs(args.output_dir, exist_ok=True)
+            with open(span_file + ".tmp", "wb") as f:
+                np.savez(
+                    f,
+                    spans=spans,
+                    num_center_spans=num_center_spans,
+                    video_names=np.array(self.videos.video_names),
+                )
+            os.replace(span_file + ".tmp", span_file)
+        except OSError as e:
+            logger.warning("Could not save span index %s: %s", span_file, e)
+        return spans, num_center_spans
+
+    def span_gap(self):
+        return 60 if (self.evaluate and not self.args.is_end_task) else 1
+
+    def build_spans(self):
+        """(video_idx, center_sec, tail_sec) spans and the number of center
+        spans, which come first.
 
-        for video_name in self.videos.keys():
+        A span is kept if any second of its window is populated, counted with
+        binary searches into each video's sorted seconds.
+        """
+        half = self.secs_per_example // 2
+        gap = self.span_gap()
+
+        center_spans, tail_spans = [], []
+        for video_idx in range(len(self.videos.video_names)):
+            secs = self.videos.video_secs(video_idx)
+
+            # for action recognition only, both train and test use 15 min only.
+            centers = np.arange(EVAL_START_SEC, EVAL_END_SEC)
+            counts = np.searchsorted(secs, centers + half) - np.searchsorted(
+                secs, centers - half
+            )
+            center_spans.append(make_spans(video_idx, centers[counts > 0], None))
 
-            v = self.videos[video_name]
             # complete spans
-            range_start = min(v.keys()) + self.secs_per_example - 1
-            range_end = max(v.keys()) + 1
-            gap = 60 if (self.evaluate and not args.is_end_task) else 1
-
-            for tail_sec in range(range_start, range_end, gap):
-                if (
-                    sum(
-                        [
-                            sec in v.keys()
-                            for sec in range(
-                                tail_sec + 1 - self.secs_per_example, tail_sec + 1
-                            )
-                        ]
-                    )
-                    > 0
-                ):
+            tails = np.arange(secs[0] + self.secs_per_example - 1, secs[-1] + 1, gap)
+            counts = np.searchsorted(secs, tails + 1) - np.searchsorted(
+                secs, tails + 1 - self.secs_per_example
+            )
+            tail_spans.append(make_spans(video_idx, None, tails[counts > 0]))
+
+        center_spans = np.concatenate(center_spans)
+        return np.concatenate([center_spans] + tail_spans), len(center_spans)
+
+    def join_features(self):
+        self.feature_rows = self.all_features.lookup(
+            self.videos.video_names,
+            self.videos.video_idx,
+            self.videos.secs,
+            self.videos.box_ids,
+            self.box_table,
+        )
+        logger.info(
+            "%d of %d boxes have no features"
+            % ((self.feature_rows == -1).sum(), len(self.feature_rows))
+        )
 
-                    self.spans.append((video_name, None, tail_sec))
+    def cache_reduction(self, model):
+        """Load or build reduction(features) of every feature row, as an fp16
+        memmap in output_dir keyed by the feature files and the layer weights.
 
-        print(len(set([x[0] for x in self.spans])), "videos in spans in total")
-        print(len(self.videos), "video data loaded in total")
+        Batches then carry the reduced features after the raw ones, which are
+        still needed as decoder inputs and for masking: this saves the
+        reduction's FLOPs, not batch I/O. Only valid while the reduction layer
+        is frozen.
+        """
+        args = self.args
+        model = model.module if hasattr(model, "module") else model
+        reduction = model.roberta.embeddings.reduction
+        feature_file = (
+            args.eval_feature_file if self.evaluate else args.train_feature_file
+        )
 
-    def __len__(self):
+        weights = hashlib.md5()
+        for p in (reduction.weight, reduction.bias):
+            weights.update(p.detach().float().cpu().numpy().tobytes())
+        key = {
+            "feature_files": [
+                (f, os.stat(f).st_mtime_ns, os.stat(f).st_size)
+                for f in video_data_helper.split_file_names(feature_file)
+                if f
+            ],
+            "reduction": weights.hexdigest(),
+        }
+        cache_file = os.path.join(
+            args.output_dir,
+            "reduction_{}.npy".format(
+                hashlib.md5(repr(key).encode("utf-8")).hexdigest()[:12]
+            ),
+        )
+
+        if not os.path.exists(cache_file) or args.overwrite_cache:
+            features = self.all_features.features
+            os.makedirs(args.output_dir, exist_ok=True)
+            out = np.lib.format.open_memmap(
+                cache_file + ".tmp",
+                mode="w+",
+                dtype=np.float16,
+                shape=(len(features), reduction.out_features),
+            )
+            with torch.no_grad():
+                for start in range(0, len(features), 16384):
+                    chunk = torch.from_numpy(
+                        np.asarray(features[start : start + 16384], dtype=np.float32)
+                    ).to(reduction.weight.device)
+                    out[start : start + len(chunk)] = reduction(chunk).cpu().numpy()
+            out.flush()
+            del out
+            os.replace(cache_file + ".tmp", cache_file)
+            logger.info("Reduced features written to %s", cache_file)
+
+        logger.info("Loading reduced features from %s", cache_file)
+        self.reduced_features = np.load(cache_file, mmap_mode="r")
+        self.reduction_bias = reduction.bias.detach().float().cpu().numpy()
+
+    def fill_reduced_features(self, features, ex_idx, token_pos, feature_rows):
+        """Writes the cached reduction of feature_rows after the raw features
+        of their tokens. Start, end and padding tokens have zero features, so
+        theirs is the reduction bias."""
+        reduced = features[..., -self.reduced_features.shape[1] :]
+        reduced[...] = self.reduction_bias
+        reduced[ex_idx, token_pos] = self.reduced_features[feature_rows]
+
+    def feature_dim(self):
+        dim = self.all_features.features.shape[1]
+        if self.reduced_features is not None:
+            dim += self.reduced_features.shape[1]
+        return dim
+
+    def allocate_feature_ring(
+        self, batch_size, num_workers, prefetch_factor, batch_sampler=None
+    ):
+        """Build batch features in a FeatureRing; call before the DataLoader
+        starts its workers. fp16 feature stores stay fp16 until the device.
+
+        The ring holds batch_size of the longest spans, or the largest batch
+        that batch_sampler yields.
+        """
+        dtype = (
+            torch.float16
+            if self.all_features.features.dtype == np.float16
+            else torch.float32
+        )
+        if batch_sampler is not None:
+            max_tokens = batch_sampler.max_batch_tokens()
+        else:
+            max_tokens = batch_size * int(self.span_lengths().max())
+        self.feature_ring = FeatureRing(
+            max_tokens,
+            self.feature_dim(),
+            dtype,
+            num_workers,
+            prefetch_factor,
+        )
+
+    def num_eval_spans(self):
+        # Center spans are evaluated eval_sample_x times each.
+        return (
+            self.num_center_spans * self.args.eval_sample_x
+            + len(self.spans)
+            - self.num_center_spans
+        )
+
+    def eval_span_index(self, item):
+        # Works on ints and on arrays of items.
+        item = item % self.num_eval_spans()
+        num_repeated = self.num_center_spans * self.args.eval_sample_x
+        return np.where(
+            item < num_repeated,
+            item % self.num_center_spans,
+            item - num_repeated + self.num_center_spans,
+        )
+
+    def span_index(self, item):
         if self.evaluate:
-            return len(self.spans)
+            return int(self.eval_span_index(item))
+        if self.items_are_spans:
+            return item
+        return random.randrange(len(self.spans))
+
+    def span_lengths(self):
+        """Token count of each span: boxes in its window, as capped by
+        select_rows, plus the start and end tokens."""
+        spans = self.spans.numpy()
+        shifts = self.center_shifts()
+        is_tail = spans[:, 2] != -1
+        low = np.where(
+            is_tail, spans[:, 2] - self.secs_per_example + 1, spans[:, 1] + shifts.min()
+        )
+        high = np.where(is_tail, spans[:, 2], spans[:, 1] + shifts.max())
+        counts = self.videos.count_rows(spans[:, 0], low, high)
+        return np.minimum(counts, self.args.max_position_embeddings - 4) + 2
+
+    def length_bucket_sampler(self, batch_size):
+        """LengthBucketBatchSampler over this dataset's items: spans drawn at
+        random for training, every eval item in order for evaluation.
+
+        With --max_tokens_per_batch, a TokenBudgetBatchSampler instead.
+        """
+        args = self.args
+        lengths = self.span_lengths()
+        if self.evaluate:
+            lengths = lengths[self.eval_span_index(np.arange(len(self)))]
+            sampling = dict(shuffle=False)
         else:
-            return len(set([x[0] for x in self.spans])) * int(
-                self.args.num_train_epochs
+            self.items_are_spans = True
+            sampling = dict(shuffle=True, num_samples=len(self))
+
+        if args.max_tokens_per_batch > 0:
+            return TokenBudgetBatchSampler(
+                lengths,
+                args.max_tokens_per_batch,
+                args.num_length_buckets,
+                attention_cost=args.token_budget_cost == "attention",
+                max_len=args.max_position_embeddings - 2,
+                **sampling,
             )
+        return LengthBucketBatchSampler(
+            lengths, batch_size, args.num_length_buckets, **sampling
+        )
 
-    def __getitem__(self, item):
+    def __len__(self):
         if self.evaluate:
-            selected = [self.spans[item % len(self.spans)]]
+            return self.num_eval_spans()
         else:
-            selected = [random.choice(self.spans)]
+            return self.num_span_videos * int(self.args.num_train_epochs)
 
-        ret = []
-        construct_func = self.construct_example
+    def __getitem__(self, item):
+        return self.__getitems__([item])
+
+    def __getitems__(self, items):
+        """Builds the padded batch for a list of dataset indices.
+
+        Spans are resolved to rows one example at a time; everything per token
+        is then filled in with NumPy gathers over the whole batch.
+        """
+        examples = []
+        for item in items:
+            video_idx, center_start, tail_start = self.spans[
+                self.span_index(item)
+            ].tolist()
+
+            rows, center_start = self.select_rows(
+                video_idx,
+                None if center_start == -1 else center_start,
+                None if tail_start == -1 else tail_start,
+            )
 
-        for video_name, center_start, tail_start in selected:
-            for _ in range(100):
-                one_ex = construct_func(
-                    video_name, center_start=center_start, tail_start=tail_start
-                )
-                if one_ex is not None:
-                    break
-                v = self.videos[video_name]
-                tail_start = random.choice(range(min(v.keys()), max(v.keys()) + 1))
-
-            ret.append(one_ex + [video_name])
-        return ret
-
-    def construct_example(self, video_name, center_start=None, tail_start=None):
-        def get_spatial_encoding(box, perturb=0.0):
-            box = [float(x) for x in box.split(",")]
-            if perturb > 0 and not self.evaluate:
-                p0 = (box[2] - box[0]) * perturb
-                p1 = (box[3] - box[1]) * perturb
-                box = [
-                    box[0] + p0 * random.uniform(-1.0, 1.0),
-                    box[1] + p1 * random.uniform(-1.0, 1.0),
-                    box[2] + p0 * random.uniform(-1.0, 1.0),
-                    box[3] + p1 * random.uniform(-1.0, 1.0),
-                ]
-            box.append((box[2] - box[0]) * (box[3] - box[1]))
-            return np.array(box)
+            # Links are renumbered with a random permutation per example.
+            links, link_inverse = np.unique(
+                self.videos.link_ids[rows], return_inverse=True
+            )
+            link_perm = np.array(random.sample(range(len(links)), len(links)))
+            examples.append((video_idx, rows, center_start, link_perm[link_inverse]))
 
-        args = self.args
+        return self.build_batch(examples)
 
-        video = self.videos[video_name]
+    def center_shifts(self):
+        # center, center - 1, center + 1, center - 2, center + 2, ...
+        shifts = (np.arange(self.secs_per_example) + 1) // 2
+        shifts[1::2] *= -1
+        return shifts
 
-        video_features = (
-            self.all_features[video_name] if (self.all_features is not None) else None
-        )
+    def select_rows(self, video_idx, center_start, tail_start):
+        """Rows of a span and its center (None for tail spans).
 
-        ex_link_ids = []
-        ex_scene_ids = []
-        ex_boxes = []
-        ex_secs = []
-        ex_actions = []
-        ex_long_term = []
-        ex_features = []
-        ex_spatial = []
-
-        for shift_idx, sec_shift in enumerate(range(self.secs_per_example)):
-
-            if center_start is not None:
-                if sec_shift % 2 == 0:
-                    sec = center_start + (sec_shift + 1) // 2
-                    auged_sec = center_start + (shift_idx + 1) // 2
-                else:
-                    sec = center_start - (sec_shift + 1) // 2
-                    auged_sec = center_start - (shift_idx + 1) // 2
+        Spans without any boxes are retried with a random tail in the video.
+        """
+        for _ in range(100):
             if tail_start is not None:
-                sec = tail_start - sec_shift
-                auged_sec = tail_start - shift_idx
-            if sec in video:
-                for box, (scene_id, link_id, actions) in video[sec].items():
-
-                    if len(ex_link_ids) < args.max_position_embeddings - 4:
-                        ex_link_ids.append(link_id)
-                        ex_secs.append(auged_sec)
-                        ex_scene_ids.append(scene_id)
-                        ex_boxes.append(box)
-                        ex_actions.append(binarize(actions))
+                secs = tail_start - np.arange(self.secs_per_example)
+            else:
+                secs = center_start + self.center_shifts()
 
-                        cur_feat = video_features[sec][box]
+            rows = self.videos.rows_for_secs(video_idx, secs)[
+                : self.args.max_position_embeddings - 4
+            ]
+            if len(rows) > 0:
+                return rows, center_start
 
-                        ex_features.append(cur_feat)
+            v = self.videos.video_secs(video_idx)
+            tail_start = random.choice(range(v[0], v[-1] + 1))
 
-                        ex_spatial.append(get_spatial_encoding(box, 0.2))
+        raise ValueError(
+            "No boxes found around {}".format(self.videos.video_names[video_idx])
+        )
 
-        if len(ex_secs) == 0:
-            return None
+    def get_spatial_encoding(self, box_ids, perturb=0.0):
+        boxes = self.box_table.coords[box_ids]
+        if perturb > 0 and not self.evaluate:
+            # x1/x2 move by up to perturb * width, y1/y2 by perturb * height.
+            p = np.tile(boxes[:, 2:] - boxes[:, :2], 2) * perturb
+            boxes = boxes + p * np.random.uniform(-1.0, 1.0, boxes.shape)
+        area = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+        return np.concatenate([boxes, area[:, None]], axis=1).astype(np.float32)
+
+    def build_batch(self, examples):
+        """Padded batch from (video_idx, rows, center_start, link_ids) examples.
+
+        Returns the id tensors ([B, L], padded with 1, start 2, end 3), the
+        action ids and their offsets per token, the long-term labels, the
+        features ([B, L, D], see FeatureRing) and spatial codes ([B, L, 5]) with zeros at the
+        start, end and padding, then the secs, box ids and video names.
+        """
+        args = self.args
+        halfway = args.max_position_embeddings // 2
 
-        original_ex_secs = ex_secs
-        assert (max(ex_secs) - min(ex_secs)) < args.secs_per_example
+        lengths = np.array([len(rows) for _, rows, _, _ in examples])
+        batch_size, max_len = len(examples), lengths.max() + 2
+        offsets = np.cumsum(lengths) - lengths
+        rows = np.concatenate([rows for _, rows, _, _ in examples])
+        assert (lengths > 0).all()
+
+        # Example and position of every token; position 0 is the start token.
+        ex_idx = np.repeat(np.arange(batch_size), lengths)
+        token_pos = np.arange(len(rows)) - offsets[ex_idx] + 1
+
+        feature_rows = self.feature_rows[rows]
+        assert (feature_rows >= 0).all()
+
+        secs = self.videos.secs[rows].astype(np.int64)
+        scene_ids = self.videos.scene_ids[rows].astype(np.int64)
+        min_secs = np.minimum.reduceat(secs, offsets)
+        max_secs = np.maximum.reduceat(secs, offsets)
+        min_scenes = np.minimum.reduceat(scene_ids, offsets)[ex_idx]
+        max_scenes = np.maximum.reduceat(scene_ids, offsets)[ex_idx]
+        assert (max_secs - min_secs < args.secs_per_example).all()
+
+        center_starts = np.array(
+            [
+                (high + low) // 2 if center_start is None else center_start
+                for (_, _, center_start, _), low, high in zip(
+                    examples, min_secs, max_secs
+                )
+            ]
+        )[ex_idx]
+        min_secs, max_secs = min_secs[ex_idx], max_secs[ex_idx]
+
+        # The center scene is the scene of the last box closest to the center.
+        dists = np.abs(secs - center_starts)
+        closest = dists == np.minimum.reduceat(dists, offsets)[ex_idx]
+        last_closest = np.maximum.reduceat(
+            np.where(closest, np.arange(len(rows)), -1), offsets
+        )
+        center_scene_ids = scene_ids[last_closest][ex_idx]
+
+        token_ids = np.stack(
+            [
+                np.concatenate([link_ids for _, _, _, link_ids in examples]),
+                secs - min_secs,
+                max_secs - secs,
+                np.maximum(0, secs - center_starts + halfway),
+                scene_ids - min_scenes,
+                max_scenes - scene_ids,
+                np.maximum(0, scene_ids - center_scene_ids + halfway),
+            ]
+        )
 
-        halfway = args.max_position_embeddings // 2
+        # Ids are shifted by 2 twice: once for the start/end tokens, once for
+        # the padding.
+        ids = np.ones((len(token_ids), batch_size, max_len), dtype=np.int64)
+        ids[:, :, 0] = 2
+        ids[:, np.arange(batch_size), lengths + 1] = 3
+        ids[:, ex_idx, token_pos] = token_ids + 4
+
+        # Actions stay sparse (CSR over the [B, L] tokens) until they reach
+        # the device, see expand_actions.
+        counts, action_ids = self.videos.actions_for_rows(rows)
+        token_counts = np.zeros((batch_size, max_len), dtype=np.int32)
+        token_counts[ex_idx, token_pos] = counts
+        action_offsets = np.zeros((batch_size * max_len + 1,), dtype=np.int32)
+        np.cumsum(token_counts.reshape(-1), out=action_offsets[1:])
+
+        if self.feature_ring is not None:
+            features = self.feature_ring.next_buffer(batch_size, max_len)
+        else:
+            features = torch.zeros((batch_size, max_len, self.feature_dim()))
+        feature_dim = self.all_features.features.shape[1]
+        features.numpy()[ex_idx, token_pos, :feature_dim] = self.all_features.gather(
+            feature_rows, dtype=features.numpy().dtype
+        )
+        if self.reduced_features is not None:
+            self.fill_reduced_features(
+                features.numpy(), ex_idx, token_pos, feature_rows
+            )
 
-        if tail_start is None:
-            tail_start = max(ex_secs)
-        if center_start is None:
-            center_start = (max(ex_secs) + min(ex_secs)) // 2
+        spatial = np.zeros((batch_size, max_len, 5), dtype=np.float32)
+        spatial[ex_idx, token_pos] = self.get_spatial_encoding(
+            self.videos.box_ids[rows], 0.2
+        )
 
-        increasing_pos_ids = [x - min(ex_secs) for x in ex_secs]
-        decreasing_pos_ids = [max(ex_secs) - x for x in ex_secs]
-        center_pos_ids = [max(0, x - center_start + halfway) for x in ex_secs]
+        return [torch.from_numpy(x) for x in ids] + [
+            (torch.from_numpy(action_ids), torch.from_numpy(action_offsets)),
+            torch.zeros((batch_size, 0)),
+            features,
+            torch.from_numpy(spatial),
+            [x.tolist() for x in np.split(secs, offsets[1:])],
+            [x.tolist() for x in np.split(self.videos.box_ids[rows], offsets[1:])],
+            [self.videos.video_names[video_idx] for video_idx, _, _, _ in examples],
+        ]
 
-        increasing_scene_ids = [x - min(ex_scene_ids) for x in ex_scene_ids]
-        decreasing_scene_ids = [max(ex_scene_ids) - x for x in ex_scene_ids]
 
-        dists = [abs(x - center_start) for x in ex_secs]
-        for dist, tmp_scene_id in zip(dists, ex_scene_ids):
-            if dist == min(dists):
-                center_scene_id = tmp_scene_id
+class EvalContext(object):
+    """Evaluation dataset, DataLoader and result accumulators, built once and
+    reused by every call to `evaluate()` so periodic evaluation only pays for
+    forward passes."""
 
-        center_scene_ids = [max(0, x - center_scene_id + halfway) for x in ex_scene_ids]
+    def __init__(self, args, model):
+        self.dataset = VideoDataset(args, evaluate=True)
+        if args.precompute_reduction:
+            self.dataset.cache_reduction(model)
 
-        n_links = len(set(ex_link_ids))
-        rand_link_ids = dict(
-            zip(
-                list(set(ex_link_ids)),
-                random.sample(range(n_links), n_links),
+        args.eval_batch_size = args.per_gpu_eval_batch_size * max(1, args.n_gpu)
+        if args.num_length_buckets > 0 or args.max_tokens_per_batch > 0:
+            batch_sampler = self.dataset.length_bucket_sampler(args.eval_batch_size)
+            batching = dict(batch_sampler=batch_sampler)
+        else:
+            batch_sampler = None
+            batching = dict(
+                sampler=SequentialSampler(self.dataset),
+                batch_size=args.eval_batch_size,
             )
+        self.dataset.allocate_feature_ring(
+            args.eval_batch_size,
+            args.num_workers_eval,
+            args.prefetch_factor,
+            batch_sampler,
+        )
+        self.dataloader = DataLoader(
+            self.dataset,
+            collate_fn=batch_collate,
+            persistent_workers=args.num_workers_eval > 0,
+            **self.dataset.feature_ring.loader_kwargs(),
+            **batching,
         )
-        ex_link_ids = [rand_link_ids[x] + 2 for x in ex_link_ids]
-
-        ex_actions = [binarize([])] + ex_actions + [binarize([])]
-
-        ex_long_term = []
-
-        ex_link_ids = [0] + ex_link_ids + [1]  # end doens't belong to a link
-
-        increasing_pos_ids = (
-            [0] + [x + 2 for x in increasing_pos_ids] + [1]
-        )  # end can have a new pos
-        decreasing_pos_ids = (
-            [0] + [x + 2 for x in decreasing_pos_ids] + [1]
-        )  # end can have a new pos
-        center_pos_ids = (
-            [0] + [x + 2 for x in center_pos_ids] + [1]
-        )  # end can have a new pos
-
-        increasing_scene_ids = [0] + [x + 2 for x in increasing_scene_ids] + [1]
-        decreasing_scene_ids = [0] + [x + 2 for x in decreasing_scene_ids] + [1]
-        center_scene_ids = [0] + [x + 2 for x in center_scene_ids] + [1]
-
-        ex_features = [ZERO_FEAT2304] + ex_features + [ZERO_FEAT2304]
-
-        ex_spatial = [ex_spatial[0] * 0.0] + ex_spatial + [ex_spatial[0] * 0.0]
-
-        return [
-            torch.tensor(ex_link_ids) + 2,
-            torch.tensor(increasing_pos_ids) + 2,
-            torch.tensor(decreasing_pos_ids) + 2,
-            torch.tensor(center_pos_ids) + 2,
-            torch.tensor(increasing_scene_ids) + 2,
-            torch.tensor(decreasing_scene_ids) + 2,
-            torch.tensor(center_scene_ids) + 2,
-            torch.tensor(ex_actions),
-            torch.tensor(ex_long_term),
-            torch.from_numpy(np.ascontiguousarray(ex_features)),
-            torch.tensor(ex_spatial),
-            ex_secs,
-            ex_boxes,
-        ]
+
+        self.action_evaluator = None
+        if args.action_recognition:
+            self.action_evaluator = ActionRecognitionEvaluator(
+                args, self.dataset.box_table
+            )
+        self.long_term_evaluator = None
+        if args.train_long_term:
+            self.long_term_evaluator = LongTermEvaluator(args, self.dataset)
 
 
 def set_seed(args):
@@ -333,6 +877,10 @@ def set_seed(args):
     if args.n_gpu > 0:
         torch.cuda.manual_seed_all(seed)
 
+    # Masking draws from its own generator on the device it runs on.
+    global mask_generator
+    mask_generator = torch.Generator(device=args.device).manual_seed(seed)
+
 
 def _sorted_checkpoints(
     args, checkpoint_prefix="checkpoint", use_mtime=False
@@ -382,73 +930,96 @@ def _rotate_checkpoints(args, checkpoint_prefix="checkpoint", use_mtime=False) -
         shutil.rmtree(checkpoint)
 
 
-def get_mask_indices(x_batch, masked_indices, features=None):
-    use_pos = None
-    if features is not None:
-        use_pos = features.sum(axis=2) != 0
-
-    for i in range(x_batch.shape[0]):
-        if use_pos is not None:
-            cur_x = x_batch[i][use_pos[i]]
-        else:
-            cur_x = x_batch[i]
+def get_mask_indices(x_batch, features=None, mask_prob=0.15, generator=None):
+    """Masks whole groups of equal ids in x_batch ([B, L] link ids).
 
-        x_ids = set(cur_x.tolist()) - set([1, 2, 3])  # remove padding, start, and end
-        assert 0 not in x_ids
+    Each group of an example is masked with probability mask_prob, conditioned
+    on at least one masked group per example. The first masked group is drawn
+    from its truncated geometric distribution and the groups after it
+    independently, which gives the same distribution as redrawing all groups
+    until one is masked, without loops or host syncs.
+    """
+    batch_size, seq_len = x_batch.shape
+    device = x_batch.device
 
-        if len(x_ids) == 0:
-            if features is not None and features.shape[-1] != 1024:
-                logger.info("warning: no masked elements in example")
-            continue
+    is_group = x_batch > 3  # remove padding, start, and end
+    used = is_group
+    if features is not None:
+        used = used & (features.sum(dim=2) != 0)
 
-        group_mask = {}
-        while sum(group_mask.values()) < 1:
-            group_mask = {
-                x_id: int(np.random.choice([0, 1], p=[0.85, 0.15])) for x_id in x_ids
-            }
+    # Link ids are renumbered per example and stay below seq_len + 4, so
+    # groups fit in a dense [B, seq_len + 4] table indexed by id.
+    present = torch.zeros((batch_size, seq_len + 4), dtype=torch.bool, device=device)
+    present.scatter_(1, torch.where(used, x_batch, 0), used)
+    num_groups = present.sum(dim=1, keepdim=True)
+    rank = present.cumsum(dim=1) - 1
 
-        for x_id in x_ids:
-            if group_mask[x_id] == 1:
-                assert x_id > 3
-                masked_indices[i, x_batch[i] == x_id] = 1
-        assert masked_indices[i].sum() > 0
+    keep_prob = 1.0 - mask_prob
+    u = 1.0 - torch.rand((batch_size, 1), generator=generator, device=device)
+    first = (
+        torch.ceil(
+            torch.log1p(-u * (1.0 - keep_prob ** num_groups.double()))
+            / np.log(keep_prob)
+        ).long()
+        - 1
+    )
+    first = torch.minimum(first, num_groups - 1)
+    rest = torch.rand(present.shape, generator=generator, device=device) < mask_prob
 
-    return masked_indices
+    group_mask = present & ((rank == first) | ((rank > first) & rest))
+    return torch.gather(group_mask, 1, x_batch) & is_group
 
 
-def perform_masking(masked_indices, inputs_embed_batch, contents):
-    mask_dim = inputs_embed_batch.shape[2]
+def perform_masking(
+    masked_indices, inputs_embed_batch, contents, masked_positions=None, generator=None
+):
+    """Masks the features of masked tokens: 80% become mask tokens, half of
+    the rest take the features of a random unreplaced content token of the
+    batch, and the others keep their own.
+
+    Works on [B, L] token indices and returns new features, the only
+    feature-sized allocation, and the [B, L] positions that the model
+    replaces with its mask embedding. Tokens copied from an earlier masking
+    pass keep the mask flag of their source.
+    """
+    batch_size, seq_len, mask_dim = inputs_embed_batch.shape
+    device = masked_indices.device
 
-    # 80% of the time, we replace masked input tokens with tokenizer.mask_token ([MASK])
     indices_replaced = (
-        torch.bernoulli(torch.full(masked_indices.shape, 0.8)).bool() & masked_indices
-    )
-
-    feat_mask = indices_replaced.view(
-        (indices_replaced.shape[0], indices_replaced.shape[1], 1)
-    ).expand(-1, -1, mask_dim)
-
-    inputs_embed_batch[feat_mask] = -10
-
-    # 10% of the time, we replace masked input tokens with random word
+        torch.rand(masked_indices.shape, generator=generator, device=device) < 0.8
+    ) & masked_indices
     indices_random = (
-        torch.bernoulli(torch.full(masked_indices.shape, 0.5)).bool()
+        (torch.rand(masked_indices.shape, generator=generator, device=device) < 0.5)
         & masked_indices
         & ~indices_replaced
     )
 
-    not_replaced = inputs_embed_batch[(~indices_replaced & contents)].reshape(
-        (-1, mask_dim)
-    )
+    # Random tokens draw uniformly, with replacement, from the unreplaced
+    # content tokens: the k-th candidate is where the running count reaches k.
+    candidate_counts = (~indices_replaced & contents).reshape(-1).cumsum(0)
+    num_candidates = candidate_counts[-1]
+    draws = (
+        torch.rand(candidate_counts.shape, generator=generator, device=device)
+        * num_candidates
+    ).long()
+    sources = torch.searchsorted(candidate_counts, draws + 1)
+
+    token_indices = torch.arange(batch_size * seq_len, device=device)
+    indices_random = indices_random.reshape(-1) & (num_candidates > 0)
+    token_indices = torch.where(indices_random, sources, token_indices)
 
-    num_to_sample = int(indices_random.sum())
-    num_features = not_replaced.shape[0]
-    if num_to_sample > 0 and num_features > 0:
-        random_indices = np.random.choice(num_features, num_to_sample)
-        inputs_embed_batch[
-            indices_random[:, :, None].repeat(1, 1, mask_dim)
-        ] = not_replaced[random_indices].reshape((-1,))
-    return inputs_embed_batch
+    masked_embed_batch = inputs_embed_batch.reshape(-1, mask_dim).index_select(
+        0, token_indices
+    )
+    if masked_positions is None:
+        masked_positions = torch.zeros_like(masked_indices)
+    masked_positions = masked_positions.reshape(-1)[token_indices] | (
+        indices_replaced.reshape(-1)
+    )
+    return (
+        masked_embed_batch.view(batch_size, seq_len, mask_dim),
+        masked_positions.view(batch_size, seq_len),
+    )
 
 
 def mask_tokens(
@@ -463,12 +1034,9 @@ def mask_tokens(
 ) -> Tuple[torch.Tensor, torch.Tensor]:
 
     ################################################################################
-    masked_indices = torch.zeros(link_batch.shape, dtype=torch.int64)
-    scene_masked_indices = None
-
-    masked_indices = get_mask_indices(link_batch, masked_indices, inputs_embed_batch)
-
-    masked_indices = masked_indices.bool()
+    masked_indices = get_mask_indices(
+        link_batch, inputs_embed_batch[:, :, : args.feat_dim], generator=mask_generator
+    )
 
     ################################################################################
     ################################################################################
@@ -483,11 +1051,7 @@ def mask_tokens(
             ~out_masked_indices[:, :, None].expand(-1, -1, args.num_action_classes)
         ] = -100  # We only compute loss on masked tokens
 
-    # 80% of the time, we replace masked input tokens with tokenizer.mask_token ([MASK])
-    indices_replaced = (
-        torch.bernoulli(torch.full(link_batch.shape, 0.8)).bool() & masked_indices
-    )
-
+    masked_positions = None
     if args.mask_sep:
         if not args.mask_sep_no_mask:
 
@@ -498,41 +1062,183 @@ def mask_tokens(
                 else:
                     assert False
 
-                inputs_embed_batch[
-                    :, :, start : start + cur_feat_dim
-                ] = perform_masking(
+                (
+                    inputs_embed_batch[:, :, start : start + cur_feat_dim],
+                    masked_positions,
+                ) = perform_masking(
                     cur_masked_indices,
                     inputs_embed_batch[:, :, start : start + cur_feat_dim],
                     contents,
+                    masked_positions=masked_positions,
+                    generator=mask_generator,
                 )
 
                 start += cur_feat_dim
 
-    inputs_embed_batch[:, :, : args.action_feat_dim] = perform_masking(
-        masked_indices, inputs_embed_batch[:, :, : args.action_feat_dim], contents
+    # Cached reduced features are masked together with the features.
+    mask_dim = args.action_feat_dim
+    if args.precompute_reduction:
+        mask_dim = inputs_embed_batch.shape[2]
+    (
+        inputs_embed_batch[:, :, :mask_dim],
+        masked_positions,
+    ) = perform_masking(
+        masked_indices,
+        inputs_embed_batch[:, :, :mask_dim],
+        contents,
+        masked_positions=masked_positions,
+        generator=mask_generator,
     )
     # The rest of the time (10% of the time) we keep the masked input tokens unchanged
-    return (action_batch, inputs_embed_batch, masked_indices)
+    return (action_batch, inputs_embed_batch, masked_indices, masked_positions)
 
 
-def shared_collate(all_examples: List[torch.Tensor]):
-    if len(all_examples[0]) == 1:
-        all_examples = [x[0] for x in all_examples]
-    elif len(all_examples[0]) == 2:
-        all_examples = [x[0] for x in all_examples] + [x[1] for x in all_examples]
+def expand_actions(action_batch, padding_mask, num_classes):
+    """Multi-hot [B, L, num_classes] labels from the (action_ids, offsets) CSR
+    built by the dataset, with -100 at padding. Built on the mask's device."""
+    action_ids, action_offsets = action_batch
+    device = padding_mask.device
 
-    assert len(all_examples[0]) == 14
-    zipped = list(zip(*all_examples))
+    counts = torch.diff(action_offsets.to(device))
+    tokens = torch.repeat_interleave(torch.arange(len(counts), device=device), counts)
+    labels = torch.zeros((len(counts), num_classes), device=device)
+    labels[tokens, action_ids.to(device).long()] = 1
+    labels = labels.view(*padding_mask.shape, num_classes)
+    labels[padding_mask] = -100
+    return labels
 
-    meta = [list(examples) for examples in zipped[9:]]
 
-    padding_value = 1
-    padding_values = [padding_value] * 7 + [-100] * 2
+def training_model_inputs(batch, args):
+    """Model keyword arguments for a training batch from the DataLoader, with
+    masking applied."""
+    (
+        link_batch,
+        inc_pos_batch,
+        dec_pos_batch,
+        center_pos_batch,
+        inc_scene_batch,
+        dec_scene_batch,
+        center_scene_batch,
+        action_batch,
+        long_term_batch,
+        feature_batch,
+        spatial_batch,
+        sec_batch,
+        box_batch,
+        video_name_batch,
+    ) = batch
+
+    (
+        action_batch,
+        link_batch,
+        inc_pos_batch,
+        dec_pos_batch,
+        center_pos_batch,
+        inc_scene_batch,
+        dec_scene_batch,
+        center_scene_batch,
+        inputs_embed_batch,
+        outputs_embed_batch,
+        spatial_batch,
+        target_locations,
+        masked_positions,
+    ) = prepare_model_input(
+        link_batch,
+        inc_pos_batch,
+        dec_pos_batch,
+        center_pos_batch,
+        inc_scene_batch,
+        dec_scene_batch,
+        center_scene_batch,
+        action_batch,
+        feature_batch,
+        spatial_batch,
+        sec_batch,
+        args,
+    )
+
+    return dict(
+        link_ids=None if args.no_link_ids else link_batch,
+        inc_scene_ids=None if args.no_scene_ids else inc_scene_batch,
+        dec_scene_ids=None if args.no_scene_ids else dec_scene_batch,
+        center_scene_ids=None if args.no_scene_ids else center_scene_batch,
+        inc_position_ids=None if args.no_pos_ids else inc_pos_batch,
+        dec_position_ids=None if args.no_pos_ids else dec_pos_batch,
+        center_position_ids=None if args.no_pos_ids else center_pos_batch,
+        action_labels=action_batch,  ####
+        long_term_labels=long_term_batch,
+        inputs_embeds=inputs_embed_batch,
+        outputs_embeds=outputs_embed_batch,
+        spatial_codes=spatial_batch,
+        target_locations=target_locations,
+        masked_positions=masked_positions,
+        secs=sec_batch,
+        boxes=box_batch,
+        args=args,
+    )
+
+
+def build_linear_probe_cache(args, train_dataloader, model):
+    """Inputs of the action head's trainable layers for the masked tokens of
+    linear_probe_passes epochs of training batches.
+
+    The frozen model runs once per batch, with the batch's random masks but
+    without dropout. Each batch becomes one (hidden, features, labels) entry,
+    kept on the CPU in fp16.
+    """
+    num_batches = args.linear_probe_passes * (
+        len(train_dataloader) // int(args.num_train_epochs)
+    )
+    cache = []
+    model.eval()
+    with torch.no_grad():
+        while len(cache) < num_batches:
+            for batch in tqdm(train_dataloader, desc="Linear probe cache"):
+                inputs = training_model_inputs(batch, args)
+                outputs = model(**inputs, output_head_hidden=True)
+                labels = inputs["action_labels"]
+                targets = labels[:, :, 0] != -100
+                cache.append(
+                    (
+                        outputs[1]["head_hidden"][targets].half().cpu(),
+                        inputs["outputs_embeds"][targets].half().cpu(),
+                        labels[targets].to(torch.uint8).cpu(),
+                    )
+                )
+                if len(cache) == num_batches:
+                    break
+    logger.info(
+        "Linear probe cache: %d batches, %d tokens",
+        len(cache),
+        sum(len(labels) for _, _, labels in cache),
+    )
+    return cache
 
-    return [
-        pad_sequence(list(examples), batch_first=True, padding_value=padding_values[i])
-        for i, examples in enumerate(zipped[:9])
-    ] + meta
+
+def linear_probe_dataloader(probe_cache, num_batches):
+    """num_batches entries of a build_linear_probe_cache cache, drawn at
+    random with replacement."""
+    return DataLoader(
+        probe_cache,
+        sampler=RandomSampler(probe_cache, replacement=True, num_samples=num_batches),
+        batch_size=None,
+    )
+
+
+def linear_probe_losses(batch, model, args):
+    """Losses of a build_linear_probe_cache batch, from the head's decoders."""
+    hidden, features, labels = [x.to(args.device).float() for x in batch]
+    head = (model.module if hasattr(model, "module") else model).action_lm_head
+    return {
+        "action": nn.functional.binary_cross_entropy_with_logits(
+            head.decode(hidden, features), labels
+        )
+    }
+
+
+def batch_collate(batch):
+    # VideoDataset.__getitems__ already returns a padded batch.
+    return batch
 
 
 def prepare_model_input(
@@ -551,15 +1257,30 @@ def prepare_model_input(
     is_eval=False,
 ):
 
-    inputs_embed_batch = pad_feature_batch(feature_batch, args.device)
+    link_batch = link_batch.to(args.device)
 
-    spatial_batch = pad_feature_batch(spatial_batch, args.device)
+    inc_pos_batch = inc_pos_batch.to(args.device)
+    dec_pos_batch = dec_pos_batch.to(args.device)
+    center_pos_batch = center_pos_batch.to(args.device)
+
+    inc_scene_batch = inc_scene_batch.to(args.device)
+    dec_scene_batch = dec_scene_batch.to(args.device)
+    center_scene_batch = center_scene_batch.to(args.device)
+
+    action_batch = expand_actions(
+        action_batch, link_batch == 1, args.num_action_classes
+    )
 
-    outputs_embed_batch = inputs_embed_batch.clone().detach()
+    inputs_embed_batch = feature_batch.to(args.device, non_blocking=True).float()
+
+    spatial_batch = spatial_batch.to(args.device, non_blocking=True)
+
+    outputs_embed_batch = inputs_embed_batch[:, :, : args.feat_dim].clone().detach()
     (
         action_batch,
         inputs_embed_batch,
         target_locations,
+        masked_positions,
     ) = mask_tokens(
         link_batch,
         inc_scene_batch,
@@ -571,21 +1292,6 @@ def prepare_model_input(
         dec_pos_batch=dec_pos_batch,
     )
 
-    if action_batch is not None:
-        action_batch = action_batch.to(args.device)
-
-    target_locations = target_locations.to(args.device)
-
-    link_batch = link_batch.to(args.device)
-
-    inc_pos_batch = inc_pos_batch.to(args.device)
-    dec_pos_batch = dec_pos_batch.to(args.device)
-    center_pos_batch = center_pos_batch.to(args.device)
-
-    inc_scene_batch = inc_scene_batch.to(args.device)
-    dec_scene_batch = dec_scene_batch.to(args.device)
-    center_scene_batch = center_scene_batch.to(args.device)
-
     return (
         action_batch,
         link_batch,
@@ -599,6 +1305,7 @@ def prepare_model_input(
         outputs_embed_batch,
         spatial_batch,
         target_locations,
+        masked_positions,
     )
 
 
@@ -610,38 +1317,40 @@ def freeze(mod):
     logger.info("freeze {} ({} params)".format(mod, count))
 
 
-def pad_feature_batch(feature_batch, device):
-    batch_size = len(feature_batch)
-    max_len = max([len(x) for x in feature_batch])
-    dim = feature_batch[0][0].shape[0]
-
-    batch = torch.zeros((batch_size, max_len, dim), device=device)
-    for i in range(batch_size):
-        batch[i, : len(feature_batch[i])] = feature_batch[i].to(device)
-    return batch
-
-
-def train(args, train_dataset, model: PreTrainedModel) -> Tuple[int, float]:
+def train(
+    args, train_dataset, model: PreTrainedModel, eval_context=None
+) -> Tuple[int, float]:
     """Train the model"""
 
     args.train_batch_size = args.per_gpu_train_batch_size * max(1, args.n_gpu)
+    if args.precompute_reduction:
+        train_dataset.cache_reduction(model)
 
-    train_sampler = (
-        RandomSampler(train_dataset)
-        if args.local_rank == -1
-        else DistributedSampler(train_dataset)
+    use_batch_sampler = args.num_length_buckets > 0 or args.max_tokens_per_batch > 0
+    if use_batch_sampler and args.local_rank == -1:
+        batch_sampler = train_dataset.length_bucket_sampler(args.train_batch_size)
+        batching = dict(batch_sampler=batch_sampler)
+    else:
+        if use_batch_sampler:
+            logger.warning(
+                "Length buckets and token budgets are not used with distributed training"
+            )
+        batch_sampler = None
+        train_sampler = (
+            RandomSampler(train_dataset)
+            if args.local_rank == -1
+            else DistributedSampler(train_dataset)
+        )
+        batching = dict(sampler=train_sampler, batch_size=args.train_batch_size)
+    train_dataset.allocate_feature_ring(
+        args.train_batch_size, args.num_workers, args.prefetch_factor, batch_sampler
     )
 
-    def collate(all_examples: List[torch.Tensor]):
-        return shared_collate(all_examples)
-
     train_dataloader = DataLoader(
         train_dataset,
-        sampler=train_sampler,
-        batch_size=args.train_batch_size,
-        collate_fn=collate,
-        num_workers=args.num_workers,
-        pin_memory=True,
+        collate_fn=batch_collate,
+        **train_dataset.feature_ring.loader_kwargs(),
+        **batching,
     )
 
     if args.max_steps > 0:
@@ -815,6 +1524,13 @@ def train(args, train_dataset, model: PreTrainedModel) -> Tuple[int, float]:
     logger.info(
         "  Instantaneous batch size per GPU = %d", args.per_gpu_train_batch_size
     )
+    if isinstance(batch_sampler, TokenBudgetBatchSampler):
+        logger.info(
+            "  Token budget per batch = %d (%s), %d batches per epoch",
+            args.max_tokens_per_batch,
+            args.token_budget_cost,
+            len(batch_sampler),
+        )
     logger.info(
         "  Total train batch size (w. parallel, distributed & accumulation) = %d",
         args.train_batch_size
@@ -898,9 +1614,24 @@ def train(args, train_dataset, model: PreTrainedModel) -> Tuple[int, float]:
 
     logger.info(model)
 
+    probe_cache = None
+    if args.linear_probe_passes > 0:
+        # Only the head's decoders train: draw each step's batch from a cache
+        # of their inputs, for as many steps as the DataLoader has batches.
+        probe_cache = build_linear_probe_cache(args, train_dataloader, model)
+        train_dataloader = linear_probe_dataloader(probe_cache, len(train_dataloader))
+
     is_first_epoch = True
     for cur_epoch in train_iterator:
-        if steps_remain_in_current_epoch > -1:
+        epoch_dataloader = train_dataloader
+        if probe_cache is not None:
+            # A resumed first epoch only draws its remaining steps.
+            if is_first_epoch and steps_remain_in_current_epoch > -1:
+                epoch_dataloader = linear_probe_dataloader(
+                    probe_cache, steps_remain_in_current_epoch
+                )
+            is_first_epoch = False
+        elif steps_remain_in_current_epoch > -1:
             tr_d = train_dataloader.dataset
             if is_first_epoch:
                 original_dataset_len = len(tr_d)
@@ -910,77 +1641,18 @@ def train(args, train_dataset, model: PreTrainedModel) -> Tuple[int, float]:
                 tr_d.force_len = original_dataset_len
 
         epoch_iterator = tqdm(
-            train_dataloader, desc="Iteration", disable=args.local_rank not in [-1, 0]
+            epoch_dataloader, desc="Iteration", disable=args.local_rank not in [-1, 0]
         )
 
-        for step, (
-            link_batch,
-            inc_pos_batch,
-            dec_pos_batch,
-            center_pos_batch,
-            inc_scene_batch,
-            dec_scene_batch,
-            center_scene_batch,
-            action_batch,
-            long_term_batch,
-            feature_batch,
-            spatial_batch,
-            sec_batch,
-            box_batch,
-            video_name_batch,
-        ) in enumerate(epoch_iterator):
-
-            (
-                action_batch,
-                link_batch,
-                inc_pos_batch,
-                dec_pos_batch,
-                center_pos_batch,
-                inc_scene_batch,
-                dec_scene_batch,
-                center_scene_batch,
-                inputs_embed_batch,
-                outputs_embed_batch,
-                spatial_batch,
-                target_locations,
-            ) = prepare_model_input(
-                link_batch,
-                inc_pos_batch,
-                dec_pos_batch,
-                center_pos_batch,
-                inc_scene_batch,
-                dec_scene_batch,
-                center_scene_batch,
-                action_batch,
-                feature_batch,
-                spatial_batch,
-                sec_batch,
-                args,
-            )
-
-            model.train()
-
-            outputs = model(
-                link_ids=None if args.no_link_ids else link_batch,
-                inc_scene_ids=None if args.no_scene_ids else inc_scene_batch,
-                dec_scene_ids=None if args.no_scene_ids else dec_scene_batch,
-                center_scene_ids=None if args.no_scene_ids else center_scene_batch,
-                inc_position_ids=None if args.no_pos_ids else inc_pos_batch,
-                dec_position_ids=None if args.no_pos_ids else dec_pos_batch,
-                center_position_ids=None if args.no_pos_ids else center_pos_batch,
-                action_labels=action_batch,  ####
-                long_term_labels=long_term_batch,
-                inputs_embeds=inputs_embed_batch,
-                outputs_embeds=outputs_embed_batch,
-                spatial_codes=spatial_batch,
-                target_locations=target_locations,
-                secs=sec_batch,
-                boxes=box_batch,
-                args=args,
-            )
-            losses = outputs[
-                0
-            ]  # model outputs are always tuple in transformers (see doc)
+        for step, batch in enumerate(epoch_iterator):
+            if probe_cache is not None:
+                losses = linear_probe_losses(batch, model, args)
+            else:
+                model.train()
+                outputs = model(**training_model_inputs(batch, args))
+                losses = outputs[
+                    0
+                ]  # model outputs are always tuple in transformers (see doc)
 
             if step == 0:
                 logger.info(losses)
@@ -1045,7 +1717,9 @@ def train(args, train_dataset, model: PreTrainedModel) -> Tuple[int, float]:
                         and args.evaluate_during_training
                         and not args.is_end_task
                     ):  # Only evaluate when single GPU otherwise metrics may not average well
-                        results = evaluate(args, model)
+                        if eval_context is None:
+                            eval_context = EvalContext(args, model)
+                        results = evaluate(args, model, eval_context=eval_context)
 
                     logger.info(("lr", scheduler.get_lr()[0], global_step))
                     logger.info(
@@ -1110,7 +1784,6 @@ def train(args, train_dataset, model: PreTrainedModel) -> Tuple[int, float]:
 
             epoch_len = len(train_dataloader) // int(args.num_train_epochs)
 
-
             if args.max_steps > 0 and global_step > args.max_steps:
                 epoch_iterator.close()
                 break
@@ -1122,71 +1795,180 @@ def train(args, train_dataset, model: PreTrainedModel) -> Tuple[int, float]:
     return global_step, tr_loss / global_step
 
 
-def evaluate_action_recognition(bert_all_preds, args):
+class ActionRecognitionEvaluator(object):
+    """Averages the sigmoid scores of every center token into the AVA
+    baseline rows it predicts, one batch at a time, and scores the result
+    with the AVA mAP.
+
+    Memory is fixed by the number of baseline rows, whatever the size of
+    the eval set and `eval_sample_x`.
+    """
+
+    def __init__(self, args, box_table):
+        self.ava = get_ava_eval_context(
+            args.ava_eval_data_file, args.ava_predictions_file
+        )
+        self.keys, self.row_keys = self.ava.prediction_keys(box_table)
+        self.scores = np.zeros(
+            (self.keys.shape[0], self.ava.preds.shape[1]), dtype=self.ava.preds.dtype
+        )
+        self.counts = np.zeros((self.keys.shape[0],), dtype=np.int64)
+        self.num_workers = args.ava_eval_workers
+        self.results_format = (
+            None if args.ava_results_format == "none" else args.ava_results_format
+        )
+        self.results_dir = args.output_dir
+
+    def reset(self):
+        self.scores[:] = 0.0
+        self.counts[:] = 0
+
+    def update(self, outputs, video_name_batch, sec_batch, box_batch, action_batch):
+        ava = self.ava
+        pred_batch = outputs["pred"].cpu()
+        is_center = (action_batch[:, :, 0] != -100).cpu()
+
+        # Token j + 1 holds the prediction for the j-th (sec, box) of an example.
+        lengths = np.array([len(secs) for secs in sec_batch])
+        ex_idx = np.repeat(np.arange(len(lengths)), lengths)
+        token_pos = np.arange(lengths.sum()) - (np.cumsum(lengths) - lengths)[ex_idx]
+        video_idx = np.array(
+            [ava.video_name_to_idx[name] for name in video_name_batch], dtype=np.int64
+        )
+        pred_keys = np.stack(
+            [
+                video_idx[ex_idx],
+                np.concatenate(sec_batch).astype(np.int64),
+                np.concatenate(box_batch).astype(np.int64),
+            ],
+            axis=1,
+        )
+        center = is_center[:, 1:].numpy()[ex_idx, token_pos]
+        rows = video_data_helper.join_rows(pred_keys[center], self.keys)
+        used = rows >= 0
+        preds = torch.sigmoid(pred_batch[:, 1:]).numpy()[ex_idx, token_pos][center]
+        np.add.at(self.scores, rows[used], preds[used])
+        np.add.at(self.counts, rows[used], 1)
+
+    def finalize(self):
+        ava = self.ava
+
+        logger.info("set all_preds to bert")
+        all_preds = ava.preds
+        all_preds[:, :] = 0.0
+        row_counts = self.counts[self.row_keys]
+        has_pred = row_counts > 0
+        all_preds[has_pred] = (
+            self.scores[self.row_keys[has_pred]] / row_counts[has_pred, None]
+        )
+        used_count = int(has_pred.sum())
 
-    logger.info("bert output to dict")
-    bert_preds = {}
-    for pred_batch, video_name_batch, sec_batch, box_batch, is_center in bert_all_preds:
-        pred_batch = torch.sigmoid(pred_batch)
+        logger.info("%d predictions used" % used_count)
+        logger.info("%d predictions in total" % all_preds.shape[0])
+
+        start_eval = time.time()
+        mean_ap = ava_eval_helper.evaluate_ava(
+            all_preds,
+            ava.ori_boxes,
+            ava.metadata.tolist(),
+            ava.excluded_keys,
+            ava.class_whitelist,
+            ava.categories,
+            groundtruth=ava.groundtruth,
+            video_idx_to_name=ava.video_idx_to_name,
+            num_workers=self.num_workers,
+            results_format=self.results_format,
+            results_dir=self.results_dir,
+        )
+        logger.info("eval done in {} secs".format(time.time() - start_eval))
+        return {"map": mean_ap * 100.0}
+
+
+class LongTermEvaluator(object):
+    """Aggregates long-term predictions per video as batches arrive: summed
+    softmax scores for classification, a running mean for regression."""
+
+    def __init__(self, args, eval_dataset):
+        self.args = args
+        self.eval_dataset = eval_dataset
+        self.reset()
+
+    def reset(self):
+        self.pred_agg = {}
+        self.pred_count = {}
+        self.video_label = {}
+        self.clip_se = 0.0
+        self.clip_count = 0
+        self.top1 = 0.0
+        self.count = 0
+
+    def update(self, outputs, video_name_batch, long_term_batch):
+        args = self.args
+        pred_batch = outputs["long_term_logits"].cpu()
+        label_batch = long_term_batch[:, 1]
+
+        if args.num_long_term_classes > 0:
+            self.top1 += (pred_batch.argmax(dim=1) == label_batch).sum()
+            self.count += label_batch.shape[0]
+        else:
+            pred_batch = pred_batch[:, 0]
 
         for i in range(len(video_name_batch)):
-            video_idx = video_name_to_idx[video_name_batch[i]]
+            v_name = video_name_batch[i]
+            if args.num_long_term_classes > 0:
+                pred = softmax(pred_batch[i])
+            else:
+                pred = float(pred_batch[i])
+                self.clip_se += float((pred_batch[i] - label_batch[i]) ** 2.0)
+                self.clip_count += 1
+
+            if v_name not in self.pred_agg:
+                self.pred_agg[v_name] = pred
+                self.pred_count[v_name] = 1
+                self.video_label[v_name] = label_batch[i]
+            else:
+                self.pred_agg[v_name] += pred
+                self.pred_count[v_name] += 1
+                assert self.video_label[v_name] == label_batch[i]
+
+    def finalize(self):
+        args = self.args
+        eval_dataset = self.eval_dataset
+        result = {
+            "clip_mse": (
+                self.clip_se / self.clip_count if self.clip_count > 0 else np.nan
+            ),
+            "long_term_top1": (
+                float(self.top1) / float(self.count) if self.count > 0 else 0.0
+            ),
+        }
+
+        for split in ["val", "test"] if args.three_split else ["val"]:
+            agg_sm_correct, agg_count = 0.0, 0.0
+            mse = []
 
-            secs = sec_batch[i]
-            boxes = box_batch[i]
-            for j, (ex_sec, ex_box) in enumerate(zip(secs, boxes)):
+            for v_name in self.pred_agg.keys():
+                if args.three_split and split == "val":
+                    if v_name not in eval_dataset.val_set:
+                        continue
 
-                if not is_center[i, j + 1]:
-                    continue
-                if video_idx not in bert_preds:
-                    bert_preds[video_idx] = {}
+                if args.three_split and split == "test":
+                    if v_name not in eval_dataset.test_set:
+                        continue
 
-                if isinstance(ex_sec, int):
-                    sec_list = [ex_sec]
-                    box_list = [ex_box]
+                if args.num_long_term_classes > 0:
+                    if self.pred_agg[v_name].argmax() == self.video_label[v_name]:
+                        agg_sm_correct += 1
                 else:
-                    sec_list = ex_sec
-                    box_list = ex_box
-                for sec, box in zip(sec_list, box_list):
-                    if sec not in bert_preds[video_idx]:
-                        bert_preds[video_idx][sec] = {}
-
-                    if box in bert_preds[video_idx][sec]:
-                        #### WTF it should be j + 1.
-                        bert_preds[video_idx][sec][box].append(pred_batch[i, j + 1])
-                    else:
-                        bert_preds[video_idx][sec][box] = [pred_batch[i, j + 1]]
-
-    logger.info("set all_preds to bert")
-    used_count = 0
-    all_preds[:, :] = 0.0
-    for i in range(all_preds.shape[0]):
-        video_idx = int(all_metadata[i][0])
-        sec = int(all_metadata[i][1])
-        box = ",".join(["%.03f" % x for x in all_ori_boxes[i][1:]])
-        if (
-            video_idx in bert_preds
-            and sec in bert_preds[video_idx]
-            and box in bert_preds[video_idx][sec]
-        ):
-            pred_list = bert_preds[video_idx][sec][box]
-            all_preds[i, :] = sum(pred_list) / len(pred_list)
-            used_count += 1
-
-    logger.info("%d predictions used" % used_count)
-    logger.info("%d predictions in total" % all_preds.shape[0])
-
-    mean_ap = evaluate_ava(
-        all_preds,
-        all_ori_boxes,
-        all_metadata.tolist(),
-        excluded_keys,
-        class_whitelist,
-        categories,
-        groundtruth=groundtruth,
-        video_idx_to_name=video_idx_to_name,
-    )
-    return mean_ap * 100.0
+                    mean_pred = self.pred_agg[v_name] / self.pred_count[v_name]
+                    mse.append((mean_pred - self.video_label[v_name]) ** 2.0)
+                agg_count += 1
+            if args.num_long_term_classes > 0:
+                acc = 100.0 * agg_sm_correct / agg_count
+                result["agg_" + split] = f"{acc} {agg_sm_correct} {agg_count}"
+            else:
+                result["agg_" + split] = f"{np.mean(mse)} {len(mse)}"
+        return result
 
 
 def softmax(x):
@@ -1195,34 +1977,21 @@ def softmax(x):
     return e_x / e_x.sum()
 
 
-def evaluate(args, model: PreTrainedModel, prefix="") -> Dict:
+def evaluate(args, model: PreTrainedModel, prefix="", eval_context=None) -> Dict:
 
     logger.info(model)
 
     # Loop to handle MNLI double evaluation (matched, mis-matched)
     eval_output_dir = args.output_dir
 
-    eval_dataset = VideoDataset(args, evaluate=True)
+    if eval_context is None:
+        eval_context = EvalContext(args, model)
+    eval_dataset = eval_context.dataset
+    eval_dataloader = eval_context.dataloader
 
     if args.local_rank in [-1, 0]:
         os.makedirs(eval_output_dir, exist_ok=True)
 
-    args.eval_batch_size = args.per_gpu_eval_batch_size * max(1, args.n_gpu)
-    # Note that DistributedSampler samples randomly
-
-    def collate(all_examples: List[torch.Tensor]):
-        return shared_collate(all_examples)
-
-    eval_sampler = SequentialSampler(eval_dataset)
-    eval_dataloader = DataLoader(
-        eval_dataset,
-        sampler=eval_sampler,
-        batch_size=args.eval_batch_size,
-        collate_fn=collate,
-        num_workers=args.num_workers_eval,
-        pin_memory=True,
-    )
-
     # multi-gpu evaluate
     if args.n_gpu > 1 and not isinstance(model, torch.nn.DataParallel):
         model = torch.nn.DataParallel(model)
@@ -1234,15 +2003,15 @@ def evaluate(args, model: PreTrainedModel, prefix="") -> Dict:
     eval_loss = 0.0
     all_eval_loss = 0.0
 
-    long_term_top1 = 0.0
-    long_term_count = 0
-
     nb_eval_steps = 0
     eval_example_count = 0
     model.eval()
 
-    all_preds = []
-    all_states = []
+    action_evaluator = eval_context.action_evaluator
+    long_term_evaluator = eval_context.long_term_evaluator
+    for evaluator in [action_evaluator, long_term_evaluator]:
+        if evaluator is not None:
+            evaluator.reset()
     for (
         link_batch,
         inc_pos_batch,
@@ -1273,6 +2042,7 @@ def evaluate(args, model: PreTrainedModel, prefix="") -> Dict:
             outputs_embed_batch,
             spatial_batch,
             target_locations,
+            masked_positions,
         ) = prepare_model_input(
             link_batch,
             inc_pos_batch,
@@ -1304,36 +2074,20 @@ def evaluate(args, model: PreTrainedModel, prefix="") -> Dict:
                 outputs_embeds=outputs_embed_batch,
                 spatial_codes=spatial_batch,
                 target_locations=target_locations,
+                masked_positions=masked_positions,
                 secs=sec_batch,
                 boxes=box_batch,
                 args=args,
             )
             losses = outputs[0]
-            if args.action_recognition:
-                all_preds.append(
-                    (
-                        outputs[1]["pred"].cpu(),
-                        video_name_batch,
-                        sec_batch,
-                        box_batch,
-                        (action_batch[:, :, 0] != -100).cpu(),
-                    )
+            if action_evaluator is not None:
+                action_evaluator.update(
+                    outputs[1], video_name_batch, sec_batch, box_batch, action_batch
+                )
+            if long_term_evaluator is not None:
+                long_term_evaluator.update(
+                    outputs[1], video_name_batch, long_term_batch
                 )
-
-            if args.train_long_term:
-                lt_pred = outputs[1]["long_term_logits"].cpu()
-                lt_labels = long_term_batch[:, 1]
-
-                if args.num_long_term_classes == -1:
-                    lt_pred = lt_pred[:, 0]
-
-                all_preds.append((video_name_batch, lt_pred, lt_labels))
-
-                if args.num_long_term_classes > 0:
-                    lt_pred = outputs[1]["long_term_logits"].argmax(dim=1).cpu()
-                    lt_labels = long_term_batch[:, 1]
-                    long_term_top1 += (lt_pred == lt_labels).sum()
-                    long_term_count += lt_labels.shape[0]
 
             if args.mask_sep:
                 eval_loss += losses["lm_action"].mean().item()
@@ -1345,81 +2099,23 @@ def evaluate(args, model: PreTrainedModel, prefix="") -> Dict:
 
         nb_eval_steps += 1
 
-    mean_ap = 0.0
-    if args.action_recognition:
-        start_eval = time.time()
-        mean_ap = evaluate_action_recognition(all_preds, args)
-        logger.info("eval done in {} secs".format(time.time() - start_eval))
-
-    clip_mse = []
-    split_result = {}
-    if args.train_long_term:
-        pred_agg = {}
-        video_label = {}
-
-        for video_name_batch, pred_batch, label_batch in all_preds:
-            for i in range(len(video_name_batch)):
-                v_name = video_name_batch[i]
-                if v_name not in pred_agg:
-                    if args.num_long_term_classes > 0:
-                        pred_agg[v_name] = softmax(pred_batch[i])
-                    else:
-                        pred_agg[v_name] = [pred_batch[i]]
-                    video_label[v_name] = label_batch[i]
-                else:
-                    if args.num_long_term_classes > 0:
-                        pred_agg[v_name] += softmax(pred_batch[i])
-                    else:
-                        pred_agg[v_name].append(pred_batch[i])
-
-                    assert video_label[v_name] == label_batch[i]
-
-                if args.num_long_term_classes == -1:
-                    clip_mse.append((pred_batch[i] - label_batch[i]) ** 2.0)
-
-        for split in ["val", "test"] if args.three_split else ["val"]:
-            agg_sm_correct, agg_count = 0.0, 0.0
-            mse = []
-
-            for v_name in pred_agg.keys():
-                if args.three_split and split == "val":
-                    if v_name not in eval_dataset.val_set:
-                        continue
-
-                if args.three_split and split == "test":
-                    if v_name not in eval_dataset.test_set:
-                        continue
-
-                if args.num_long_term_classes > 0:
-                    if pred_agg[v_name].argmax() == video_label[v_name]:
-                        agg_sm_correct += 1
-                else:
-                    mse.append((np.mean(pred_agg[v_name]) - video_label[v_name]) ** 2.0)
-                agg_count += 1
-            if args.num_long_term_classes > 0:
-                acc = 100.0 * agg_sm_correct / agg_count
-                split_result[split] = f"{acc} {agg_sm_correct} {agg_count}"
-            else:
-                split_result[split] = f"{np.mean(mse)} {len(mse)}"
-
     eval_loss = eval_loss / nb_eval_steps
     all_eval_loss = all_eval_loss / nb_eval_steps
     perplexity = torch.exp(torch.tensor(eval_loss))
     total_perplexity = torch.exp(torch.tensor(all_eval_loss))
 
-    if long_term_count > 0:
-        long_term_top1 = float(long_term_top1) / float(long_term_count)
-
     result = {
         "perplexity": perplexity,
         "all_eval_loss": all_eval_loss,
         "total_perplexity": total_perplexity,
-        "map": mean_ap,
-        "clip_mse": np.mean(clip_mse),
-        "long_term_top1": long_term_top1,
+        "map": 0.0,
+        "clip_mse": np.nan,
+        "long_term_top1": 0.0,
     }
-    for split in split_result.keys():
-        result["agg_" + split] = split_result[split]
+    if action_evaluator is not None:
+        result.update(action_evaluator.finalize())
+    if long_term_evaluator is not None:
+        result.update(long_term_evaluator.finalize())
 
     output_eval_file = os.path.join(eval_output_dir, prefix, "eval_results.txt")
     with open(output_eval_file, "w") as writer:
@@ -1659,6 +2355,65 @@ def main():
     parser.add_argument(
         "--num_workers_eval", type=int, default=2, help="Number of DataLoader workers."
     )
+    parser.add_argument(
+        "--prefetch_factor",
+        type=int,
+        default=2,
+        help="Batches each DataLoader worker loads ahead; sizes the feature ring.",
+    )
+    parser.add_argument(
+        "--num_length_buckets",
+        type=int,
+        default=0,
+        help="Batch spans of similar length together, using this many length "
+        "buckets (0 to disable).",
+    )
+    parser.add_argument(
+        "--linear_probe_passes",
+        type=int,
+        default=0,
+        help="With --action_recognition, run the frozen encoder over this many "
+        "epochs of masked training batches once and train the head's decoders "
+        "from the cached outputs (0 to disable).",
+    )
+    parser.add_argument(
+        "--precompute_reduction",
+        action="store_true",
+        help="With --action_recognition, project the features with the frozen "
+        "reduction layer once, cache them as fp16 in output_dir and skip the "
+        "projection in the model. Saves FLOPs only: batches carry the projected "
+        "features in addition to the raw ones, so batch I/O grows.",
+    )
+    parser.add_argument(
+        "--attention_backend",
+        type=str,
+        default="sdpa",
+        choices=["sdpa", "chunked", "eager"],
+        help="Self-attention implementation: torch's fused scaled_dot_product_attention, "
+        "eager attention over chunks of queries, or eager attention over whole sequences.",
+    )
+    parser.add_argument(
+        "--packed_encoder",
+        action="store_true",
+        help="Run the encoder and action head on the real tokens of a batch "
+        "only, with attention computed per sequence.",
+    )
+    parser.add_argument(
+        "--max_tokens_per_batch",
+        type=int,
+        default=0,
+        help="Fill batches up to this many padded tokens instead of a fixed "
+        "batch size (0 to disable). Spans are sorted into --num_length_buckets "
+        "buckets, or by exact length without them.",
+    )
+    parser.add_argument(
+        "--token_budget_cost",
+        type=str,
+        default="tokens",
+        choices=["tokens", "attention"],
+        help="Cost of a batch against --max_tokens_per_batch: its padded tokens "
+        "B * L, or its attention cost B * L^2 relative to full-length spans.",
+    )
     parser.add_argument(
         "--force_load_checkpoint",
         type=str,
@@ -1683,6 +2438,32 @@ def main():
     )
 
     parser.add_argument("--exp", default="", type=str, required=True, help="")
+    parser.add_argument(
+        "--ava_eval_data_file",
+        default=os.path.join(AVA_BASELINE_DIR, "ava_eval_data.pkl"),
+        type=str,
+        help="AVA groundtruth/labelmap pickle, or its .npz form "
+        "(python -m utils.ava_eval_helper).",
+    )
+    parser.add_argument(
+        "--ava_predictions_file",
+        default=os.path.join(AVA_BASELINE_DIR, "predictions-29.4.pkl"),
+        type=str,
+        help="Short-term baseline predictions pickle, or its .npz form.",
+    )
+    parser.add_argument(
+        "--ava_eval_workers",
+        type=int,
+        default=0,
+        help="Processes for labeling AVA detections; 0 or 1 evaluates serially.",
+    )
+    parser.add_argument(
+        "--ava_results_format",
+        default="none",
+        choices=["none", "csv", "npz"],
+        help="Dump AVA detections and groundtruth to the output dir after each "
+        "evaluation, on a background thread.",
+    )
     parser.add_argument("--num_action_classes", type=int, default=80, help="")
     parser.add_argument("--max_position_embeddings", type=int, default=258, help="")
     parser.add_argument("--action_recognition", action="store_true", help="")
@@ -1722,6 +2503,23 @@ def main():
 
     args.all_feat_dims = [2304]
 
+    if args.precompute_reduction and (
+        not args.action_recognition
+        or args.mask_sep
+        or args.action_feat_dim != args.feat_dim
+    ):
+        raise ValueError(
+            "--precompute_reduction needs --action_recognition, which freezes the "
+            "reduction layer, and masking of whole features without --mask_sep."
+        )
+    if args.linear_probe_passes > 0 and (
+        not args.action_recognition or args.local_rank != -1
+    ):
+        raise ValueError(
+            "--linear_probe_passes needs --action_recognition, which freezes all "
+            "but the head's decoders, and no distributed training."
+        )
+
     if (
         args.model_type in ["bert", "roberta", "distilbert", "camembert"]
         and not args.mlm
@@ -1842,6 +2640,14 @@ def main():
     proj_W = proj_W.to(args.device)
     proj_b = proj_b.to(args.device)
 
+    # Built once for the periodic evaluations during training and the final
+    # one of end tasks.
+    eval_context = None
+    if (args.is_end_task and args.local_rank in [-1, 0]) or (
+        args.do_train and args.evaluate_during_training and args.local_rank == -1
+    ):
+        eval_context = EvalContext(args, model)
+
     # Training
     if args.do_train:
         if args.local_rank not in [-1, 0]:
@@ -1852,10 +2658,15 @@ def main():
         if args.local_rank == 0:
             torch.distributed.barrier()
 
-        global_step, tr_loss = train(args, train_dataset, model)
+        global_step, tr_loss = train(
+            args, train_dataset, model, eval_context=eval_context
+        )
         logger.info(" global_step = %s, average loss = %s", global_step, tr_loss)
     if args.is_end_task and args.local_rank in [-1, 0]:
-        evaluate(args, model)
+        evaluate(args, model, eval_context=eval_context)
+
+    # Results are written in the background; surface any write failure.
+    ava_eval_helper.wait_for_results()
 
 
 if __name__ == "__main__":
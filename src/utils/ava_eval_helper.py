@@ -29,10 +29,14 @@ from __future__ import (
     print_function,
     unicode_literals,
 )
+import concurrent.futures
 import csv
 import logging
 import numpy as np
+import os
+import pickle
 import pprint
+import threading
 import time
 from collections import defaultdict
 
@@ -43,6 +47,12 @@ from .ava_evaluation import (
 
 logger = logging.getLogger(__name__)
 
+# Groundtruth files already written by this process, the thread writing
+# the latest results and the error it failed with, see `write_results_async`.
+_written_groundtruth = set()
+_results_writer = None
+_results_error = None
+
 
 def make_image_key(video_id, timestamp):
     """Returns a unique identifier for a video id & timestamp."""
@@ -142,8 +152,15 @@ def evaluate_ava(
     groundtruth=None,
     video_idx_to_name=None,
     name="latest",
+    num_workers=0,
+    results_format=None,
+    results_dir=".",
 ):
-    """Run AVA evaluation given numpy arrays."""
+    """Run AVA evaluation given numpy arrays.
+
+    Detections and groundtruth are only dumped when `results_format` is set
+    ("csv" or "npz"), on a background thread, see `write_results_async`.
+    """
 
     eval_start = time.time()
 
@@ -160,39 +177,81 @@ def evaluate_ava(
         "Evaluating with %d unique detection frames" % len(detections[0])
     )
 
-    write_results(detections, "detections_%s.csv" % name)
-    write_results(groundtruth, "groundtruth_%s.csv" % name)
+    if results_format is not None:
+        write_results_async(
+            detections, groundtruth, results_dir, name, results_format
+        )
 
-    results = run_evaluation(categories, groundtruth, detections, excluded_keys)
+    results = run_evaluation(
+        categories,
+        groundtruth,
+        detections,
+        excluded_keys,
+        num_workers=num_workers,
+    )
 
     logger.info("AVA eval done in %f seconds." % (time.time() - eval_start))
     return results["PascalBoxes_Precision/mAP@0.5IOU"]
 
 
 def run_evaluation(
-    categories, groundtruth, detections, excluded_keys, verbose=True
+    categories,
+    groundtruth,
+    detections,
+    excluded_keys,
+    verbose=True,
+    num_workers=0,
 ):
-    """AVA evaluation main logic."""
+    """AVA evaluation main logic.
+
+    With `num_workers` > 1 the per-image TP/FP labeling of the detections is
+    sharded across a process pool, see `add_detections_parallel`.
+    """
 
     pascal_evaluator = object_detection_evaluation.PascalDetectionEvaluator(
         categories
     )
 
-    boxes, labels, _ = groundtruth
+    gt_keys = included_keys(groundtruth[0], excluded_keys, "ground truth")
+    add_groundtruth(pascal_evaluator, groundtruth, gt_keys)
+
+    pred_keys = included_keys(detections[0], excluded_keys, "detections")
+    if num_workers > 1:
+        add_detections_parallel(
+            pascal_evaluator,
+            categories,
+            groundtruth,
+            detections,
+            pred_keys,
+            num_workers,
+        )
+    else:
+        add_detections(pascal_evaluator, detections, pred_keys)
+
+    metrics = pascal_evaluator.evaluate()
 
-    gt_keys = []
-    pred_keys = []
+    pprint.pprint(metrics, indent=2)
+    return metrics
 
+
+def included_keys(boxes, excluded_keys, source):
+    """Image keys of `boxes` in order, without the excluded timestamps."""
+    image_keys = []
     for image_key in boxes:
         if image_key in excluded_keys:
             logging.info(
-                (
-                    "Found excluded timestamp in ground truth: %s. "
-                    "It will be ignored."
-                ),
+                "Found excluded timestamp in %s: %s. It will be ignored.",
+                source,
                 image_key,
             )
             continue
+        image_keys.append(image_key)
+    return image_keys
+
+
+def add_groundtruth(pascal_evaluator, groundtruth, image_keys):
+    boxes, labels, _ = groundtruth
+    for image_key in image_keys:
         pascal_evaluator.add_single_ground_truth_image_info(
             image_key,
             {
@@ -208,20 +267,10 @@ def run_evaluation(
             },
         )
 
-        gt_keys.append(image_key)
 
+def add_detections(pascal_evaluator, detections, image_keys):
     boxes, labels, scores = detections
-
-    for image_key in boxes:
-        if image_key in excluded_keys:
-            logging.info(
-                (
-                    "Found excluded timestamp in detections: %s. "
-                    "It will be ignored."
-                ),
-                image_key,
-            )
-            continue
+    for image_key in image_keys:
         pascal_evaluator.add_single_detected_image_info(
             image_key,
             {
@@ -237,12 +286,68 @@ def run_evaluation(
             },
         )
 
-        pred_keys.append(image_key)
 
-    metrics = pascal_evaluator.evaluate()
+def evaluate_detection_shard(categories, groundtruth, detections):
+    """Per-class (scores, tp_fp_labels) chunks of one shard of images, in
+    the order `add_detections` would have produced them."""
+    pascal_evaluator = object_detection_evaluation.PascalDetectionEvaluator(
+        categories
+    )
+    add_groundtruth(pascal_evaluator, groundtruth, list(groundtruth[0]))
+    add_detections(pascal_evaluator, detections, list(detections[0]))
+    evaluation = pascal_evaluator._evaluation
+    return evaluation.scores_per_class, evaluation.tp_fp_labels_per_class
 
-    pprint.pprint(metrics, indent=2)
-    return metrics
+
+def add_detections_parallel(
+    pascal_evaluator,
+    categories,
+    groundtruth,
+    detections,
+    image_keys,
+    num_workers,
+    shards_per_worker=4,
+):
+    """`add_detections` with the images split into contiguous shards that
+    are labeled in a process pool.
+
+    The groundtruth statistics stay with `pascal_evaluator`; workers only
+    return per-class chunks, which are appended shard by shard so every
+    class sees its detections in the serial order and the mAP is identical.
+    """
+    num_shards = min(len(image_keys), num_workers * shards_per_worker)
+    bounds = np.linspace(0, len(image_keys), num_shards + 1).astype(int)
+
+    def select(data, shard_keys):
+        return tuple(
+            {key: values[key] for key in shard_keys if key in values}
+            for values in data
+        )
+
+    with concurrent.futures.ProcessPoolExecutor(num_workers) as executor:
+        futures = []
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            shard_keys = image_keys[start:end]
+            futures.append(
+                executor.submit(
+                    evaluate_detection_shard,
+                    categories,
+                    select(groundtruth, shard_keys),
+                    select(detections, shard_keys),
+                )
+            )
+
+        evaluation = pascal_evaluator._evaluation
+        for future in futures:
+            scores_per_class, tp_fp_labels_per_class = future.result()
+            for class_index in range(evaluation.num_class):
+                evaluation.scores_per_class[class_index].extend(
+                    scores_per_class[class_index]
+                )
+                evaluation.tp_fp_labels_per_class[class_index].extend(
+                    tp_fp_labels_per_class[class_index]
+                )
+    evaluation.detection_keys.update(image_keys)
 
 
 def get_ava_eval_data(
@@ -284,6 +389,93 @@ def get_ava_eval_data(
     return out_boxes, out_labels, out_scores
 
 
+def load_eval_data(path):
+    """Loads (excluded_keys, class_whitelist, categories, groundtruth,
+    video_idx_to_name) from a pickle, or from the .npz written by
+    `save_eval_data`."""
+    if not path.endswith(".npz"):
+        with open(path, "rb") as f:
+            return pickle.load(f)
+
+    with np.load(path) as f:
+        categories = [
+            {"id": class_id, "name": name}
+            for class_id, name in zip(
+                f["category_ids"].tolist(), f["category_names"].tolist()
+            )
+        ]
+        bounds = np.cumsum(f["gt_counts"])[:-1]
+        groundtruth = tuple(
+            defaultdict(
+                list,
+                zip(
+                    f["gt_keys"].tolist(),
+                    [values.tolist() for values in np.split(f[name], bounds)],
+                ),
+            )
+            for name in ["gt_boxes", "gt_labels", "gt_scores"]
+        )
+        return (
+            set(f["excluded_keys"].tolist()),
+            set(f["class_whitelist"].tolist()),
+            categories,
+            groundtruth,
+            f["video_idx_to_name"].tolist(),
+        )
+
+
+def save_eval_data(eval_data, path):
+    """Writes the tuple returned by `load_eval_data` as a compact .npz."""
+    (
+        excluded_keys,
+        class_whitelist,
+        categories,
+        groundtruth,
+        video_idx_to_name,
+    ) = eval_data
+    boxes, labels, scores = groundtruth
+    keys = list(boxes.keys())
+
+    np.savez(
+        path,
+        excluded_keys=np.array(sorted(excluded_keys), dtype=str),
+        class_whitelist=np.array(sorted(class_whitelist), dtype=np.int64),
+        category_ids=np.array([c["id"] for c in categories], dtype=np.int64),
+        category_names=np.array([c["name"] for c in categories], dtype=str),
+        gt_keys=np.array(keys, dtype=str),
+        gt_counts=np.array([len(boxes[key]) for key in keys], dtype=np.int64),
+        gt_boxes=np.array(
+            [box for key in keys for box in boxes[key]], dtype=np.float64
+        ).reshape(-1, 4),
+        gt_labels=np.array(
+            [label for key in keys for label in labels[key]], dtype=np.int64
+        ),
+        gt_scores=np.array(
+            [score for key in keys for score in scores[key]], dtype=np.float64
+        ),
+        video_idx_to_name=np.array(video_idx_to_name, dtype=str),
+    )
+
+
+def load_predictions(path):
+    """Loads (preds, original_boxes, metadata) arrays from a pickle, or from
+    the .npz written by `save_predictions`."""
+    if not path.endswith(".npz"):
+        with open(path, "rb") as f:
+            return pickle.load(f)
+
+    with np.load(path) as f:
+        return f["preds"], f["original_boxes"], f["metadata"]
+
+
+def save_predictions(predictions, path):
+    """Writes the tuple returned by `load_predictions` as an .npz."""
+    preds, original_boxes, metadata = predictions
+    np.savez(
+        path, preds=preds, original_boxes=original_boxes, metadata=metadata
+    )
+
+
 def write_results(detections, filename):
     """Write prediction results into official formats."""
     start = time.time()
@@ -299,3 +491,128 @@ def write_results(detections, filename):
 
     logger.info("AVA results wrote to %s" % filename)
     logger.info("\ttook %d seconds." % (time.time() - start))
+
+
+def save_results(detections, filename):
+    """Writes (boxes, labels, scores) dicts keyed by image as an .npz with
+    the layout of the groundtruth in `save_eval_data`."""
+    start = time.time()
+
+    boxes, labels, scores = detections
+    keys = list(boxes.keys())
+    np.savez(
+        filename,
+        keys=np.array(keys, dtype=str),
+        counts=np.array([len(boxes[key]) for key in keys], dtype=np.int64),
+        boxes=np.array(
+            [box for key in keys for box in boxes[key]], dtype=np.float64
+        ).reshape(-1, 4),
+        labels=np.array(
+            [label for key in keys for label in labels[key]], dtype=np.int64
+        ),
+        scores=np.array(
+            [score for key in keys for score in scores[key]], dtype=np.float64
+        ),
+    )
+
+    logger.info("AVA results wrote to %s" % filename)
+    logger.info("\ttook %d seconds." % (time.time() - start))
+
+
+def load_results(filename):
+    """Reads the (boxes, labels, scores) dicts written by `save_results`."""
+    with np.load(filename) as f:
+        bounds = np.cumsum(f["counts"])[:-1]
+        return tuple(
+            defaultdict(
+                list,
+                zip(
+                    f["keys"].tolist(),
+                    [values.tolist() for values in np.split(f[name], bounds)],
+                ),
+            )
+            for name in ["boxes", "labels", "scores"]
+        )
+
+
+RESULT_WRITERS = {
+    "csv": (write_results, ".csv"),
+    "npz": (save_results, ".npz"),
+}
+
+
+def wait_for_results():
+    """Blocks until the results handed to `write_results_async` are written,
+    and re-raises the error the writer failed with, if any."""
+    global _results_error
+
+    if _results_writer is not None:
+        _results_writer.join()
+    if _results_error is not None:
+        error, _results_error = _results_error, None
+        raise error
+
+
+def _write_results(write, jobs):
+    global _results_error
+
+    try:
+        for job in jobs:
+            write(*job)
+    except Exception as error:
+        _results_error = error
+
+
+def write_results_async(detections, groundtruth, results_dir, name, fmt):
+    """Writes the detections, and the groundtruth the first time its path is
+    seen, in format `fmt` on a background thread.
+
+    A previous write is waited for first, so files are never written by two
+    threads at once. Errors surface from the next `wait_for_results`.
+    """
+    global _results_writer
+
+    write, extension = RESULT_WRITERS[fmt]
+    jobs = [
+        (
+            detections,
+            os.path.join(results_dir, "detections_%s%s" % (name, extension)),
+        )
+    ]
+    groundtruth_file = os.path.join(
+        results_dir, "groundtruth_%s%s" % (name, extension)
+    )
+    if groundtruth_file not in _written_groundtruth:
+        _written_groundtruth.add(groundtruth_file)
+        jobs.append((groundtruth, groundtruth_file))
+
+    wait_for_results()
+    _results_writer = threading.Thread(
+        target=_write_results, args=(write, jobs), name="ava-results"
+    )
+    _results_writer.start()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Convert pickled AVA eval data and baseline predictions to .npz."
+    )
+    parser.add_argument("eval_data_file", help="Pickled AVA eval data.")
+    parser.add_argument(
+        "predictions_file", help="Pickled baseline predictions."
+    )
+    parser.add_argument("out_dir", help="Directory for the two .npz files.")
+    cli_args = parser.parse_args()
+
+    for in_file, load, save in [
+        (cli_args.eval_data_file, load_eval_data, save_eval_data),
+        (cli_args.predictions_file, load_predictions, save_predictions),
+    ]:
+        out_file = os.path.join(
+            cli_args.out_dir,
+            os.path.splitext(os.path.basename(in_file))[0] + ".npz",
+        )
+        save(load(in_file), out_file)
+        print("Wrote %s" % out_file)
@@ -33,6 +33,7 @@ from . import (
     np_box_list_ops,
     np_box_mask_list,
     np_box_mask_list_ops,
+    np_box_ops,
 )
 
 
@@ -177,6 +178,17 @@ class PerImageEvaluation(object):
                 "Groundtruth masks is available but detected masks is not."
             )
 
+        if detected_masks is None:
+            return self._compute_tp_fp_box_mode(
+                detected_boxes,
+                detected_scores,
+                detected_class_labels,
+                groundtruth_boxes,
+                groundtruth_class_labels,
+                groundtruth_is_difficult_list,
+                groundtruth_is_group_of_list,
+            )
+
         result_scores = []
         result_tp_fp_labels = []
         for i in range(self.num_groundtruth_classes):
@@ -215,6 +227,101 @@ class PerImageEvaluation(object):
             result_tp_fp_labels.append(tp_fp_labels)
         return result_scores, result_tp_fp_labels
 
+    def _compute_tp_fp_box_mode(
+        self,
+        detected_boxes,
+        detected_scores,
+        detected_class_labels,
+        groundtruth_boxes,
+        groundtruth_class_labels,
+        groundtruth_is_difficult_list,
+        groundtruth_is_group_of_list,
+    ):
+        """Labels true/false positives of box detections for all classes at once.
+
+    Gives the same result as running `_compute_tp_fp_for_single_class` on
+    every class, but the IOU of each distinct detected box is computed once
+    per image instead of once per class, and the greedy matching is done with
+    array operations: a detection is matched to its highest-IOU groundtruth
+    box of the same class, and only the first detection (in input order)
+    matched to a non-difficult box is a true positive.
+
+    Args:
+      detected_boxes: A float numpy array of shape [N, 4], representing N
+          regions of detected object regions.
+      detected_scores: A float numpy array of shape [N], representing
+          the confidence scores of the detected N object instances.
+      detected_class_labels: A integer numpy array of shape [N], representing
+          the class labels of the detected N object instances.
+      groundtruth_boxes: A float numpy array of shape [M, 4], representing M
+          regions of object instances in ground truth
+      groundtruth_class_labels: An integer numpy array of shape [M],
+          representing M class labels of object instances in ground truth
+      groundtruth_is_difficult_list: A boolean numpy array of length M denoting
+          whether a ground truth box is a difficult instance or not
+      groundtruth_is_group_of_list: A boolean numpy array of length M denoting
+          whether a ground truth box has group-of tag
+
+    Returns:
+      result_scores: A list of float numpy arrays, one per class, as returned
+          by `_compute_tp_fp`.
+      result_tp_fp_labels: A list of boolean numpy arrays, one per class, as
+          returned by `_compute_tp_fp`.
+    """
+        num_class = self.num_groundtruth_classes
+        in_range = (detected_class_labels >= 0) & (
+            detected_class_labels < num_class
+        )
+        detected_boxes = detected_boxes[in_range]
+        detected_scores = detected_scores[in_range]
+        detected_class_labels = detected_class_labels[in_range]
+
+        is_non_group_of = ~groundtruth_is_group_of_list
+        gt_boxes = groundtruth_boxes[is_non_group_of]
+        gt_class_labels = groundtruth_class_labels[is_non_group_of]
+        gt_is_difficult = groundtruth_is_difficult_list[is_non_group_of]
+
+        tp_fp_labels = np.zeros(detected_scores.shape[0], dtype=bool)
+        is_matched_to_difficult_box = np.zeros(
+            detected_scores.shape[0], dtype=bool
+        )
+        if detected_boxes.size > 0 and gt_boxes.size > 0:
+            # Boxes repeat across classes, so IOU is computed once per box.
+            unique_boxes, box_index = np.unique(
+                detected_boxes, axis=0, return_inverse=True
+            )
+            iou = np_box_ops.iou(unique_boxes, gt_boxes)[box_index.reshape(-1)]
+            # IOU is non-negative, so other classes never win the argmax.
+            other_class = detected_class_labels[:, None] != gt_class_labels
+            iou[other_class] = -1.0
+            max_overlap_gt_ids = np.argmax(iou, axis=1)
+            is_matched = (
+                iou[np.arange(iou.shape[0]), max_overlap_gt_ids]
+                >= self.matching_iou_threshold
+            )
+            is_matched_to_difficult_box = (
+                is_matched & gt_is_difficult[max_overlap_gt_ids]
+            )
+            candidates = np.flatnonzero(
+                is_matched & ~is_matched_to_difficult_box
+            )
+            _, first = np.unique(
+                max_overlap_gt_ids[candidates], return_index=True
+            )
+            tp_fp_labels[candidates[first]] = True
+
+        keep = ~is_matched_to_difficult_box
+        scores = detected_scores[keep]
+        tp_fp_labels = tp_fp_labels[keep]
+        class_labels = detected_class_labels[keep]
+
+        order = np.argsort(class_labels, kind="stable")
+        splits = np.cumsum(np.bincount(class_labels, minlength=num_class))[:-1]
+        return (
+            np.split(scores[order], splits),
+            np.split(tp_fp_labels[order], splits),
+        )
+
     def _get_overlaps_and_scores_box_mode(
         self,
         detected_boxes,
@@ -0,0 +1,38 @@
+import numpy as np
+
+from run import TokenBudgetBatchSampler
+
+
+def make_sampler(lengths, max_tokens, attention_cost):
+    return TokenBudgetBatchSampler(
+        lengths,
+        max_tokens,
+        0,
+        shuffle=False,
+        attention_cost=attention_cost,
+        max_len=256,
+    )
+
+
+def test_attention_budget_bounds_short_batches():
+    rng = np.random.default_rng(0)
+    lengths = np.concatenate([np.arange(3, 257), rng.integers(3, 257, 2000)])
+
+    for max_tokens in [2000, 8192]:
+        sampler = make_sampler(lengths, max_tokens, attention_cost=True)
+        bound = sampler.max_batch_tokens()
+        assert bound <= 10 * max_tokens
+
+        for items in [np.arange(len(lengths)), rng.permutation(len(lengths))]:
+            for batch in sampler.split(items):
+                assert len(batch) * lengths[batch].max() <= bound
+                assert len(batch) == 1 or lengths[batch].sum() <= max_tokens
+
+
+def test_token_budget_is_tight():
+    lengths = np.array([3, 3, 3, 10, 10, 256])
+    sampler = make_sampler(lengths, 30, attention_cost=False)
+
+    batches = sampler.split(np.arange(len(lengths)))
+    assert [batch.tolist() for batch in batches] == [[0, 1, 2], [3, 4], [5]]
+    assert sampler.max_batch_tokens() == 256
@@ -0,0 +1,62 @@
+import types
+
+import numpy as np
+import torch
+
+from models import RobertaConfig
+from models.modeling_roberta import RobertaEmbeddings
+from run import VideoDataset
+
+
+def test_cached_reduction_matches_uncached_embeddings():
+    torch.manual_seed(0)
+    feat_dim, hidden_size = 8, 16
+    config = RobertaConfig(
+        vocab_size=None,
+        hidden_size=hidden_size,
+        feat_dim=feat_dim,
+        max_position_embeddings=20,
+    )
+    args = types.SimpleNamespace(
+        no_pos_ids=True,
+        no_scene_ids=True,
+        no_link_ids=True,
+        feat_dim=feat_dim,
+        action_feat_dim=feat_dim,
+        mask_sep=False,
+        precompute_reduction=False,
+    )
+    embeddings = RobertaEmbeddings(config, args).eval()
+    with torch.no_grad():
+        embeddings.reduction.bias.normal_()
+        embeddings.masked_embedding[0].normal_()
+
+    # Two examples of 3 and 2 tokens: start token at 0, end token after the
+    # content, then padding.
+    table = torch.randn(6, feat_dim)
+    feature_rows = np.array([4, 0, 2, 5, 1])
+    ex_idx = np.array([0, 0, 0, 1, 1])
+    token_pos = np.array([1, 2, 3, 1, 2])
+    masked_positions = torch.zeros((2, 5), dtype=torch.bool)
+    masked_positions[0, 2] = True
+
+    features = torch.zeros((2, 5, feat_dim))
+    features[ex_idx, token_pos] = table[feature_rows]
+    with torch.no_grad():
+        expected = embeddings(
+            inputs_embeds=features.clone(), masked_positions=masked_positions
+        )
+
+        dataset = types.SimpleNamespace(
+            reduced_features=embeddings.reduction(table).numpy(),
+            reduction_bias=embeddings.reduction.bias.numpy(),
+        )
+        cached = torch.zeros((2, 5, feat_dim + hidden_size))
+        cached[..., :feat_dim] = features
+        VideoDataset.fill_reduced_features(
+            dataset, cached.numpy(), ex_idx, token_pos, feature_rows
+        )
+        args.precompute_reduction = True
+        actual = embeddings(inputs_embeds=cached, masked_positions=masked_positions)
+
+    assert torch.allclose(actual, expected, atol=1e-5)